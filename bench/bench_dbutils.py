@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+'''Compares dbutils.hash_join, semi_join and group_by with the
+hand-written loops they replace.
+
+Usage: bench_dbutils.py [rows ...]
+
+Rows default to 100000 and 1000000. Rows are dbrow rows with about ten
+rows per key on the grouped side. Times are the best of three runs.
+
+Speedups over the loops at 1000000 rows (noisy to about 0.1x):
+
+                               python 3.11  python 2.7
+    join, unique right keys       1.09x        1.76x
+    join, duplicate right keys    1.29x        1.32x
+    anti join                     1.34x        2.35x
+    group by                      1.25x        1.57x
+
+The unique key join is barely faster than the loop on python 3, the
+loop there paying little for its dict lookups.
+'''
+
+from __future__ import print_function
+
+import os.path
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from olib import dbrow, dbutils
+
+def best_of(function, repeat=3):
+    best = None
+    for attempt in range(repeat):
+        start = time.time()
+        function()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def loop_join_unique(left, right):
+    index = {}
+    for row in right:
+        index[row['id']] = row
+    pairs = []
+    for row in left:
+        match = index.get(row['ref_id'])
+        if match is not None:
+            pairs.append((row, match))
+    return pairs
+
+def loop_join(left, right):
+    groups = {}
+    for row in right:
+        groups.setdefault(row['ref_id'], []).append(row)
+    pairs = []
+    for row in left:
+        for match in groups.get(row['ref_id'], ()):
+            pairs.append((row, match))
+    return pairs
+
+def loop_anti_join(left, right):
+    keys = set()
+    for row in right:
+        keys.add(row['id'])
+    return [row for row in left if row['ref_id'] not in keys]
+
+def loop_group_by(rows):
+    keys = []
+    groups = {}
+    for row in rows:
+        key = row['ref_id']
+        group = groups.get(key)
+        if group is None:
+            keys.append(key)
+            group = groups[key] = [0, 0]
+        group[0] += 1
+        group[1] += row['value']
+    return [(key, groups[key][0], groups[key][1]) for key in keys]
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [100000, 1000000]
+    row_class = dbrow.row_class(('id', 'ref_id', 'value'))
+    for size in sizes:
+        keys = size // 10
+        # parents have unique ids, every second one referenced;
+        # children reference parents about ten times each
+        parents = [row_class((index, index * 2 % keys, index % 7)) for index in range(keys)]
+        children = [row_class((index, index % keys, index % 100)) for index in range(size)]
+        benchmarks = [
+            ('join, unique right keys',
+                lambda: loop_join_unique(children, parents),
+                lambda: dbutils.hash_join(children, parents, 'ref_id', 'id')),
+            ('join, duplicate right keys',
+                lambda: loop_join(parents, children),
+                lambda: dbutils.hash_join(parents, children, 'id', 'ref_id')),
+            ('anti join',
+                lambda: loop_anti_join(children, parents),
+                lambda: dbutils.semi_join(children, parents, 'ref_id', 'id', anti=True)),
+            ('group by',
+                lambda: loop_group_by(children),
+                lambda: dbutils.group_by(children, 'ref_id',
+                    [('count', 'count', None), ('sum', 'sum', 'value')])),
+        ]
+        print('%d rows, python %d.%d' % ((size,) + sys.version_info[:2]))
+        for name, loop, helper in benchmarks:
+            loop_time = best_of(loop)
+            helper_time = best_of(helper)
+            print('  %-28s loop %7.3fs  dbutils %7.3fs  %5.2fx' % (
+                name, loop_time, helper_time, loop_time / helper_time))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+'''Compares CursorWrapper.insert_many and insert_many_ids with inserting
+rows one at a time with insert_dict and insert_dict_id.
+
+Usage: bench_insert.py dsn [rows ...]
+
+Rows default to 1000, 10000 and 100000. Rows are inserted into a
+temporary table within one transaction per run. Times are the best of
+three runs.
+'''
+
+from __future__ import print_function
+
+import datetime
+import os.path
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from olib import dbwrap
+
+TABLE = 'olib_bench_insert'
+
+def make_rows(count):
+    now = datetime.datetime.now()
+    return [{
+        'name': 'row %d' % index,
+        'value': index,
+        'created_at': now,
+    } for index in range(count)]
+
+def per_row(cursor, rows):
+    for row in rows:
+        cursor.insert_dict(TABLE, row)
+
+def per_row_ids(cursor, rows):
+    for row in rows:
+        cursor.insert_dict_id(TABLE, row)
+
+def values(cursor, rows):
+    # above the row count, insert_many never switches to COPY
+    cursor.insert_many(TABLE, rows, copy_threshold=len(rows) + 1)
+
+def copy(cursor, rows):
+    cursor.insert_many(TABLE, rows, copy_threshold=1)
+
+def values_ids(cursor, rows):
+    cursor.insert_many_ids(TABLE, rows)
+
+METHODS = [
+    ('insert_dict per row', per_row),
+    ('insert_many VALUES', values),
+    ('insert_many COPY', copy),
+    ('insert_dict_id per row', per_row_ids),
+    ('insert_many_ids VALUES', values_ids),
+]
+
+def run(conn, method, rows, repeat=3):
+    best = None
+    for attempt in range(repeat):
+        with conn.tx_cursor() as cursor:
+            cursor.execute('truncate %s' % TABLE)
+        start = time.time()
+        with conn.tx_cursor() as cursor:
+            method(cursor, rows)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def main():
+    if len(sys.argv) < 2:
+        print(__doc__.strip(), file=sys.stderr)
+        sys.exit(2)
+    sizes = [int(arg) for arg in sys.argv[2:]] or [1000, 10000, 100000]
+    conn = dbwrap.ConnectionWrapper(sys.argv[1])
+    conn.connect()
+    with conn.tx_cursor() as cursor:
+        cursor.execute('''
+            create temporary table %s (
+                id serial primary key,
+                name text not null,
+                value integer not null,
+                created_at timestamp not null
+            )
+        ''' % TABLE)
+    try:
+        for size in sizes:
+            rows = make_rows(size)
+            print('%d rows' % size)
+            baseline = None
+            for name, method in METHODS:
+                elapsed = run(conn, method, rows)
+                if method in (per_row, per_row_ids):
+                    baseline = elapsed
+                print('  %-24s %8.3fs %10.0f rows/s %7.1fx' % (
+                    name, elapsed, size / elapsed, baseline / elapsed))
+    finally:
+        conn.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+'''Compares the size and access speed of dbrow rows with
+dtuple.DatabaseTuple.
+
+Usage: bench_rows.py [rows ...]
+
+Rows default to 100000 and 1000000, each with five columns. Sizes are
+per row, the DatabaseTuple size including its instance dict and data
+tuple but not the shared descriptor. Times are for building the rows
+and for reading one column of every row by index, by name and as an
+attribute, the best of three runs.
+'''
+
+from __future__ import print_function
+
+import os.path
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from olib import dbrow, dtuple
+
+NAMES = ('id', 'name', 'email', 'created', 'score')
+
+def best_of(function, repeat=3):
+    best = None
+    for attempt in range(repeat):
+        start = time.time()
+        function()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def row_size(row):
+    size = sys.getsizeof(row)
+    if isinstance(row, dtuple.DatabaseTuple):
+        size += sys.getsizeof(row.__dict__) + sys.getsizeof(row._data_)
+    return size
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [100000, 1000000]
+    row_class = dbrow.row_class(NAMES)
+    desc = dtuple.TupleDescriptor([(name,) for name in NAMES])
+    for size in sizes:
+        data = [(index, 'name %d' % index, 'user%d@example.com' % index, None, index % 100)
+            for index in range(size)]
+        rows = [row_class(values) for values in data]
+        tuples = [dtuple.DatabaseTuple(desc, values) for values in data]
+        benchmarks = [
+            ('build',
+                lambda: [row_class(values) for values in data],
+                lambda: [dtuple.DatabaseTuple(desc, values) for values in data]),
+            ('index access',
+                lambda: [row[1] for row in rows],
+                lambda: [row[1] for row in tuples]),
+            ('name access',
+                lambda: [row['name'] for row in rows],
+                lambda: [row['name'] for row in tuples]),
+            ('attribute access',
+                lambda: [row.name for row in rows],
+                lambda: [row.name for row in tuples]),
+        ]
+        print('%d rows, python %d.%d' % ((size,) + sys.version_info[:2]))
+        print('  %-18s dbrow %7d bytes  dtuple %7d bytes  %5.2fx' % (
+            'size per row', row_size(rows[0]), row_size(tuples[0]),
+            float(row_size(tuples[0])) / row_size(rows[0])))
+        for name, row_function, tuple_function in benchmarks:
+            row_time = best_of(row_function)
+            tuple_time = best_of(tuple_function)
+            print('  %-18s dbrow %7.3fs        dtuple %7.3fs        %5.2fx' % (
+                name, row_time, tuple_time, tuple_time / row_time))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+'''Measures the overhead of savepoint-backed nested transactions
+(ConnectionWrapper(use_savepoints=True)) per nesting level.
+
+Usage: bench_savepoints.py dsn [max_depth [iterations]]
+
+For each nesting depth up to max_depth (default 4) the script runs
+iterations (default 1000) units of work, each an insert into a temporary
+table inside depth nested transactions, all within one outer
+transaction. It compares plain nesting, which issues no statements for
+nested levels, with savepoints committed and with savepoints rolled back
+from the innermost level. Times are per unit of work, the best of three
+runs; the overhead per level is the difference to plain nesting divided
+by depth.
+'''
+
+from __future__ import print_function
+
+import os.path
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from olib import dbwrap
+
+TABLE = 'olib_bench_savepoints'
+
+class Rollback(Exception):
+    pass
+
+def unit(conn, cursor, depth, fail):
+    if depth == 0:
+        cursor.execute('insert into %s (value) values (?)' % TABLE, 1)
+        if fail:
+            raise Rollback
+        return
+    with conn.tx_cursor() as cursor:
+        unit(conn, cursor, depth - 1, fail)
+
+def run(conn, depth, iterations, fail, repeat=3):
+    best = None
+    for attempt in range(repeat):
+        start = time.time()
+        with conn.tx_cursor() as cursor:
+            for iteration in range(iterations):
+                try:
+                    unit(conn, cursor, depth, fail)
+                except Rollback:
+                    pass
+            # keep the table small between runs
+            cursor.execute('truncate %s' % TABLE)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best / iterations
+
+def connect(dsn, use_savepoints):
+    conn = dbwrap.ConnectionWrapper(dsn, use_savepoints=use_savepoints)
+    conn.connect()
+    with conn.tx_cursor() as cursor:
+        cursor.execute('create temporary table %s (value integer)' % TABLE)
+    return conn
+
+def main():
+    if len(sys.argv) < 2:
+        print(__doc__.strip(), file=sys.stderr)
+        sys.exit(2)
+    dsn = sys.argv[1]
+    max_depth = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    iterations = int(sys.argv[3]) if len(sys.argv) > 3 else 1000
+    
+    plain = connect(dsn, False)
+    savepoints = connect(dsn, True)
+    try:
+        print('%5s %12s %12s %12s %14s %14s' % ('depth', 'plain', 'savepoints',
+            'rollback', 'commit/level', 'rollback/level'))
+        for depth in range(1, max_depth + 1):
+            plain_time = run(plain, depth, iterations, False)
+            savepoint_time = run(savepoints, depth, iterations, False)
+            rollback_time = run(savepoints, depth, iterations, True)
+            print('%5d %10.1fus %10.1fus %10.1fus %12.1fus %12.1fus' % (depth,
+                plain_time * 1e6, savepoint_time * 1e6, rollback_time * 1e6,
+                (savepoint_time - plain_time) / depth * 1e6,
+                (rollback_time - plain_time) / depth * 1e6,
+            ))
+    finally:
+        plain.close()
+        savepoints.close()
+
+if __name__ == '__main__':
+    main()
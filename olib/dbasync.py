@@ -0,0 +1,435 @@
+'''asyncio front end mirroring dbwrap's higher-level interface.
+
+Requires Python 3.5 or later. Connections use psycopg2's asynchronous
+mode and are driven by the event loop, so queries do not block it.
+Asynchronous psycopg2 connections are always in autocommit mode:
+transactional cursors issue begin/commit/rollback themselves, and the
+convenience methods of AsyncConnectionWrapper run each statement on its
+own in autocommit mode.
+
+A psycopg2 connection can only run one query at a time; each connection
+serializes its queries with a lock and concurrency is obtained by
+checking out more connections from the pool.
+'''
+
+import asyncio
+import time
+
+import psycopg2, psycopg2.extensions
+
+from . import dbrow
+from .dbwrap import NotFoundError, MissingCursorDescriptionError, \
+    PoolTimeoutError, PoolClosedError, WHITESPACE_REGEXP, \
+    _prepare_query, _insert_dict_query, _update_query
+from .dbutils import munge_plan as _munge_plan
+
+def _wait_for_fd(loop, fd, write):
+    future = loop.create_future()
+    
+    def ready():
+        if not future.done():
+            future.set_result(None)
+    
+    if write:
+        loop.add_writer(fd, ready)
+        future.add_done_callback(lambda future: loop.remove_writer(fd))
+    else:
+        loop.add_reader(fd, ready)
+        future.add_done_callback(lambda future: loop.remove_reader(fd))
+    return future
+
+async def _wait(conn):
+    '''Polls an asynchronous connection until its current operation
+    completes, waiting on its socket in between.'''
+    
+    loop = asyncio.get_event_loop()
+    while True:
+        state = conn.poll()
+        if state == psycopg2.extensions.POLL_OK:
+            return
+        elif state == psycopg2.extensions.POLL_READ:
+            await _wait_for_fd(loop, conn.fileno(), False)
+        elif state == psycopg2.extensions.POLL_WRITE:
+            await _wait_for_fd(loop, conn.fileno(), True)
+        else:
+            raise psycopg2.OperationalError('Unexpected poll state: %s' % state)
+
+class AsyncConnection(object):
+    '''An asynchronous psycopg2 connection running one query at a time.'''
+    
+    def __init__(self, raw):
+        self.raw = raw
+        self.opened_at = time.time()
+        self._lock = asyncio.Lock()
+    
+    @property
+    def closed(self):
+        return self.raw.closed
+    
+    async def execute(self, sql, args):
+        '''Executes sql and returns the psycopg2 cursor holding its results.'''
+        
+        async with self._lock:
+            cursor = self.raw.cursor()
+            try:
+                cursor.execute(sql, args)
+                await _wait(self.raw)
+            except asyncio.CancelledError:
+                # the query may still be running, the connection
+                # cannot be used for anything else
+                self.close()
+                raise
+            return cursor
+    
+    def close(self):
+        if not self.raw.closed:
+            self.raw.close()
+
+class AsyncConnectionPool(object):
+    '''Pool of AsyncConnections, see dbwrap.ConnectionPool.'''
+    
+    def __init__(self, dsn, min_size=1, max_size=10, timeout=30,
+        max_idle=600, max_lifetime=3600, check=True,
+    ):
+        if max_size < 1:
+            raise ValueError('max_size must be at least 1')
+        if min_size > max_size:
+            raise ValueError('min_size cannot exceed max_size')
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.max_lifetime = max_lifetime
+        self.check = check
+        # (connection, time returned) pairs, most recently returned last
+        self._idle = []
+        self._size = 0
+        self._closed = False
+        # created on first use so that it belongs to the running loop
+        self._slots = None
+    
+    async def fill(self):
+        while not self._closed and self._size < self.min_size:
+            self._size += 1
+            conn = await self._open()
+            self._idle.append((conn, time.time()))
+    
+    async def acquire(self, timeout=None):
+        if self._closed:
+            raise PoolClosedError('Connection pool is closed')
+        if timeout is None:
+            timeout = self.timeout
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_size)
+        try:
+            await asyncio.wait_for(self._slots.acquire(), timeout)
+        except asyncio.TimeoutError:
+            raise PoolTimeoutError('Timed out waiting for a connection after %s seconds' % timeout)
+        try:
+            self._evict_idle()
+            while self._idle:
+                conn = self._idle.pop()[0]
+                if await self._usable(conn):
+                    return conn
+                self._discard(conn)
+            self._size += 1
+            return await self._open()
+        except BaseException:
+            self._slots.release()
+            raise
+    
+    def release(self, conn, close=False):
+        '''Returns a connection to the pool.'''
+        
+        try:
+            if not close and not conn.closed:
+                status = conn.raw.get_transaction_status()
+                # a transaction left open by its user
+                close = status != psycopg2.extensions.TRANSACTION_STATUS_IDLE
+            if close or conn.closed or self._closed or self._expired(conn, time.time()):
+                self._discard(conn)
+            else:
+                self._idle.append((conn, time.time()))
+        finally:
+            self._slots.release()
+    
+    def closeall(self):
+        self._closed = True
+        idle = self._idle
+        self._idle = []
+        for conn, returned_at in idle:
+            self._discard(conn)
+    
+    def stats(self):
+        return {
+            'size': self._size,
+            'idle': len(self._idle),
+            'in_use': self._size - len(self._idle),
+        }
+    
+    async def _open(self):
+        # the caller has already counted this connection in _size
+        try:
+            raw = psycopg2.connect(self.dsn, async_=True)
+            await _wait(raw)
+        except BaseException:
+            self._size -= 1
+            raise
+        return AsyncConnection(raw)
+    
+    def _discard(self, conn):
+        conn.close()
+        self._size -= 1
+    
+    def _expired(self, conn, now):
+        return self.max_lifetime is not None and now - conn.opened_at > self.max_lifetime
+    
+    async def _usable(self, conn):
+        if conn.closed or self._expired(conn, time.time()):
+            return False
+        if self.check:
+            try:
+                await conn.execute('select 1', None)
+            except psycopg2.Error:
+                return False
+        return True
+    
+    def _evict_idle(self):
+        now = time.time()
+        keep = []
+        for conn, returned_at in self._idle:
+            idle_too_long = self.max_idle is not None and \
+                now - returned_at > self.max_idle and self._size > self.min_size
+            if idle_too_long or self._expired(conn, now):
+                self._discard(conn)
+            else:
+                keep.append((conn, returned_at))
+        self._idle = keep
+
+class AsyncCursorWrapper(object):
+    '''Coroutine counterpart of dbwrap.CursorWrapper bound to one
+    AsyncConnection.'''
+    
+    def __init__(self, conn, debug_queries=False):
+        self.conn = conn
+        self.cursor = None
+        self._debug_queries = debug_queries
+        self._munge_mapping = None
+    
+    async def execute(self, sql, *args):
+        return await self.execute2(sql, args)
+    
+    async def execute2(self, sql, args, munge=False):
+        sql, args, self._munge_mapping = _prepare_query(sql, args, munge)
+        if self._debug_queries:
+            debug_sql = self.conn.raw.cursor().mogrify(sql, args)
+            if isinstance(debug_sql, bytes):
+                debug_sql = debug_sql.decode('utf8', 'replace')
+            print('SQL:', WHITESPACE_REGEXP.sub('     ', debug_sql.strip()))
+        self.cursor = await self.conn.execute(sql, args)
+    
+    # Higher-level interface
+    
+    async def one(self, sql, *args):
+        return await self.one2(sql, args)
+    
+    async def onem(self, sql, *args):
+        return await self.one2(sql, args, munge=True)
+    
+    async def one2(self, sql, args, **kwargs):
+        await self.execute2(sql, args, **kwargs)
+        row = self.cursor.fetchone()
+        if row is None:
+            return None
+        if self._munge_mapping:
+            return _munge_plan(self._names(), self._munge_mapping).apply(row)
+        return dbrow.description_row_class(self.cursor.description)(row)
+    
+    async def one_check(self, sql, *args):
+        return await self.one_check2(sql, args)
+    
+    async def one_checkm(self, sql, *args):
+        return await self.one_check2(sql, args, munge=True)
+    
+    async def one_check2(self, sql, args, **kwargs):
+        row = await self.one2(sql, args, **kwargs)
+        if row is None:
+            raise NotFoundError("No data %s" % repr(args))
+        return row
+    
+    async def all(self, sql, *args):
+        return await self.all2(sql, args)
+    
+    async def allm(self, sql, *args):
+        return await self.all2(sql, args, munge=True)
+    
+    async def all2(self, sql, args, **kwargs):
+        await self.execute2(sql, args, **kwargs)
+        if self.cursor.description is None:
+            raise MissingCursorDescriptionError
+        rows = self.cursor.fetchall()
+        if self._munge_mapping:
+            apply = _munge_plan(self._names(), self._munge_mapping).apply
+            return [apply(row) for row in rows]
+        row_class = dbrow.description_row_class(self.cursor.description)
+        return [row_class(row) for row in rows]
+    
+    def _names(self):
+        return [column[0] for column in self.cursor.description]
+    
+    async def one_value(self, sql, *args):
+        return await self.one_value2(sql, args)
+    
+    async def one_value2(self, sql, args):
+        await self.execute2(sql, args)
+        row = self.cursor.fetchone()
+        if row is None:
+            return None
+        return row[0]
+    
+    async def one_value_check(self, sql, *args):
+        return await self.one_value_check2(sql, args)
+    
+    async def one_value_check2(self, sql, args):
+        await self.execute2(sql, args)
+        row = self.cursor.fetchone()
+        if row is None:
+            raise NotFoundError("No data %s" % repr(args))
+        return row[0]
+    
+    async def all_values(self, sql, *args):
+        return await self.all_values2(sql, args)
+    
+    async def all_values2(self, sql, args):
+        await self.execute2(sql, args)
+        return [row[0] for row in self.cursor.fetchall()]
+    
+    # Statements
+    
+    async def insert_dict(self, table, dict):
+        sql, args = _insert_dict_query(table, dict, False)
+        await self.execute2(sql, args)
+    
+    async def insert_dict_id(self, table, dict):
+        sql, args = _insert_dict_query(table, dict, True)
+        await self.execute2(sql, args)
+        return self.cursor.fetchone()[0]
+    
+    async def update(self, table, attrs, conditions):
+        sql, args = _update_query(table, attrs, conditions)
+        await self.execute2(sql, args)
+
+class AsyncCursorContextManager(object):
+    '''Checks out a connection for the duration of an async with block.'''
+    
+    def __init__(self, wrapper):
+        self.wrapper = wrapper
+        self.conn = None
+    
+    async def __aenter__(self):
+        self.conn = await self.wrapper.pool.acquire()
+        return AsyncCursorWrapper(self.conn,
+            debug_queries=self.wrapper._debug_queries)
+    
+    async def __aexit__(self, type, value, traceback):
+        self.wrapper.pool.release(self.conn)
+
+class AsyncTransactionalCursorContextManager(AsyncCursorContextManager):
+    '''Runs an async with block in a transaction on its own connection,
+    committing if the block succeeds and rolling back otherwise.'''
+    
+    async def __aenter__(self):
+        cursor = await AsyncCursorContextManager.__aenter__(self)
+        try:
+            await self.conn.execute('begin', None)
+        except BaseException:
+            self.wrapper.pool.release(self.conn, close=True)
+            raise
+        return cursor
+    
+    async def __aexit__(self, type, value, traceback):
+        close = False
+        try:
+            if value is None:
+                await self.conn.execute('commit', None)
+            else:
+                try:
+                    await self.conn.execute('rollback', None)
+                except psycopg2.Error:
+                    # let the original exception propagate
+                    close = True
+        except BaseException:
+            close = True
+            raise
+        finally:
+            self.wrapper.pool.release(self.conn, close=close)
+
+class AsyncConnectionWrapper(object):
+    '''asyncio counterpart of dbwrap.ConnectionWrapper, always pooled.
+    
+    Use tx_cursor() in async with for transactions. one, all, etc. are
+    available directly on the wrapper and run each statement on a pooled
+    connection in autocommit mode.
+    '''
+    
+    def __init__(self, dsn,
+        debug_queries=False,
+        pool_min_size=1, pool_max_size=10, pool_timeout=30,
+        pool_max_idle=600, pool_max_lifetime=3600, pool_check=True,
+    ):
+        self.dsn = dsn
+        self._debug_queries = debug_queries
+        self.pool = AsyncConnectionPool(dsn,
+            min_size=pool_min_size, max_size=pool_max_size,
+            timeout=pool_timeout, max_idle=pool_max_idle,
+            max_lifetime=pool_max_lifetime, check=pool_check,
+        )
+    
+    async def connect(self):
+        await self.pool.fill()
+    
+    def close(self):
+        self.pool.closeall()
+    
+    def tx_cursor(self):
+        return AsyncTransactionalCursorContextManager(self)
+    
+    cursor = tx_cursor
+    
+    def autocommit_cursor(self):
+        return AsyncCursorContextManager(self)
+    
+    async def _call(self, method, *args):
+        async with AsyncCursorContextManager(self) as cursor:
+            return await getattr(cursor, method)(*args)
+    
+    async def execute(self, sql, *args):
+        return await self._call('execute2', sql, args)
+    
+    async def one(self, sql, *args):
+        return await self._call('one2', sql, args)
+    
+    async def one_check(self, sql, *args):
+        return await self._call('one_check2', sql, args)
+    
+    async def all(self, sql, *args):
+        return await self._call('all2', sql, args)
+    
+    async def one_value(self, sql, *args):
+        return await self._call('one_value2', sql, args)
+    
+    async def one_value_check(self, sql, *args):
+        return await self._call('one_value_check2', sql, args)
+    
+    async def all_values(self, sql, *args):
+        return await self._call('all_values2', sql, args)
+    
+    async def insert_dict(self, table, dict):
+        return await self._call('insert_dict', table, dict)
+    
+    async def insert_dict_id(self, table, dict):
+        return await self._call('insert_dict_id', table, dict)
+    
+    async def update(self, table, attrs, conditions):
+        return await self._call('update', table, attrs, conditions)
@@ -0,0 +1,335 @@
+'''Query result caches used by caching cursors.
+
+A cache can be private to a caching cursor or shared by all connections
+of a process. Writes made through CursorWrapper helpers invalidate
+caches of the same process when they are executed and again when their
+transaction commits, as other connections may have cached the previously
+committed rows in between. Other writes are not seen;
+CacheInvalidationListener propagates writes made by other processes
+through LISTEN/NOTIFY, with the notifications sent by triggers created
+by install_notify_triggers.
+'''
+
+import collections
+import psycopg2, psycopg2.extensions
+import re
+import select
+import sys
+import threading
+import time
+
+_TABLE_REGEXP = re.compile(r'\b(?:from|join)\s+((?:"[^"]+"|\w+)(?:\.(?:"[^"]+"|\w+))*)', re.I)
+
+def table_key(name):
+    '''Normalizes a possibly schema-qualified, possibly quoted table name
+    for use in cache invalidation.'''
+    
+    name = name.split('.')[-1]
+    if name.startswith('"'):
+        return name[1:-1]
+    return name.lower()
+
+def tables_in_sql(sql):
+    '''Returns the set of tables a query appears to read from.
+    
+    This is a textual scan of from and join clauses, it does not see
+    tables read through views or functions.
+    '''
+    
+    return frozenset([table_key(name) for name in _TABLE_REGEXP.findall(sql)])
+
+def cache_key(sql, args):
+    '''Returns a hashable cache key for a query and its arguments.'''
+    
+    if isinstance(args, dict):
+        args = tuple(sorted(args.items()))
+    else:
+        args = tuple(args)
+    # 1, 1.0 and True are equal as keys but not as sql literals
+    key = (sql, args, tuple([arg.__class__ for arg in args]))
+    try:
+        hash(key)
+    except TypeError:
+        key = (sql, repr(args))
+    return key
+
+def _approximate_size(rows):
+    size = sys.getsizeof(rows)
+    for row in rows:
+        size += sys.getsizeof(row)
+        for value in row:
+            size += sys.getsizeof(value)
+    return size
+
+class CachedResult(object):
+    __slots__ = ['rows', 'description', 'tables', 'size', 'expires_at']
+    
+    def __init__(self, rows, description, tables, size, expires_at):
+        self.rows = rows
+        self.description = description
+        self.tables = tables
+        self.size = size
+        self.expires_at = expires_at
+
+class QueryCache(object):
+    '''Thread-safe least recently used cache of query results.
+    
+    The cache holds at most max_entries results and, if max_bytes is
+    given, results of approximately max_bytes total size. Results older
+    than ttl seconds are not returned. Results are tagged with the tables
+    their queries read so that writes can invalidate them.
+    '''
+    
+    def __init__(self, max_entries=1000, max_bytes=None, ttl=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        # table -> set of keys of results reading it
+        self._tables = {}
+        self._bytes = 0
+        # incremented by every invalidation
+        self._generation = 0
+        # table -> generation of its last invalidation
+        self._invalidated_at = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+    
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry.expires_at is not None and entry.expires_at <= time.time():
+                self._forget(key, entry)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries[key] = entry
+            self.hits += 1
+            return entry
+    
+    def generation(self):
+        '''Returns a token to pass to put for a query that is about to run.'''
+        
+        return self._generation
+    
+    def put(self, key, rows, description, tables, generation=None):
+        '''Stores a result. If generation is given and any of tables was
+        invalidated after it was obtained the result is discarded, as the
+        query may have read data that changed while it ran.'''
+        
+        if self.max_bytes is not None:
+            size = _approximate_size(rows)
+            if size > self.max_bytes:
+                return
+        else:
+            size = 0
+        if self.ttl is not None:
+            expires_at = time.time() + self.ttl
+        else:
+            expires_at = None
+        entry = CachedResult(rows, description, tables, size, expires_at)
+        with self._lock:
+            if generation is not None:
+                for table in tables:
+                    if self._invalidated_at.get(table, -1) >= generation:
+                        return
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._forget(key, old)
+            self._entries[key] = entry
+            self._bytes += size
+            for table in tables:
+                self._tables.setdefault(table, set()).add(key)
+            while len(self._entries) > self.max_entries or \
+                self.max_bytes is not None and self._bytes > self.max_bytes \
+            :
+                old_key, old = self._entries.popitem(last=False)
+                self._forget(old_key, old)
+                self.evictions += 1
+    
+    def invalidate_table(self, table):
+        '''Drops all results of queries reading table.'''
+        
+        table = table_key(table)
+        with self._lock:
+            self._invalidated_at[table] = self._generation
+            self._generation += 1
+            keys = self._tables.pop(table, ())
+            for key in keys:
+                entry = self._entries.pop(key, None)
+                if entry is not None:
+                    self._forget(key, entry)
+                    self.invalidations += 1
+    
+    def clear(self):
+        with self._lock:
+            # results of queries in flight are discarded too
+            for table in self._tables:
+                self._invalidated_at[table] = self._generation
+            self._generation += 1
+            self._entries.clear()
+            self._tables.clear()
+            self._bytes = 0
+    
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            if lookups:
+                hit_ratio = float(self.hits) / lookups
+            else:
+                hit_ratio = None
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': hit_ratio,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations,
+            }
+    
+    # must be called with the lock held, after removing key from _entries
+    def _forget(self, key, entry):
+        self._bytes -= entry.size
+        for table in entry.tables:
+            keys = self._tables.get(table)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tables[table]
+
+_shared_cache = None
+_shared_cache_lock = threading.Lock()
+
+def shared_cache(**options):
+    '''Returns the process-wide QueryCache, creating it with options on
+    first use.'''
+    
+    global _shared_cache
+    if _shared_cache is None:
+        with _shared_cache_lock:
+            if _shared_cache is None:
+                _shared_cache = QueryCache(**options)
+    return _shared_cache
+
+DEFAULT_CHANNEL = 'olib_cache_invalidate'
+
+NOTIFY_FUNCTION_SQL = '''
+    create or replace function olib_notify_table_change() returns trigger as $$
+    begin
+        perform pg_notify(tg_argv[0], tg_table_name);
+        return null;
+    end
+    $$ language plpgsql
+'''
+
+def install_notify_triggers(cursor, tables, channel=DEFAULT_CHANNEL):
+    '''Creates statement-level triggers that notify channel with the
+    table name whenever one of tables is written to.
+    
+    cursor is a dbwrap.CursorWrapper.
+    '''
+    
+    from .dbwrap import SchemaName
+    
+    cursor.execute(NOTIFY_FUNCTION_SQL)
+    for table in tables:
+        trigger = SchemaName('olib_notify_%s' % table.split('.')[-1])
+        cursor.execute('''
+            drop trigger if exists %s on %s
+        ''', trigger, SchemaName(table))
+        cursor.execute('''
+            create trigger %s
+                after insert or update or delete or truncate on %s
+                for each statement
+                execute procedure olib_notify_table_change(%s)
+        ''', trigger, SchemaName(table), channel)
+
+class CacheInvalidationListener(object):
+    '''Invalidates a QueryCache when table change notifications arrive.
+    
+    Listens on channel over a dedicated connection in a daemon thread.
+    If the connection is lost notifications may have been missed, so the
+    whole cache is cleared once the listener reconnects.
+    '''
+    
+    def __init__(self, dsn, cache, channel=DEFAULT_CHANNEL,
+        poll_interval=1, reconnect_interval=5,
+    ):
+        self.dsn = dsn
+        self.cache = cache
+        self.channel = channel
+        self.poll_interval = poll_interval
+        self.reconnect_interval = reconnect_interval
+        self.notifications = 0
+        self.reconnects = 0
+        self._stopping = threading.Event()
+        self._thread = None
+    
+    def start(self):
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run,
+            name='olib-cache-invalidation')
+        self._thread.daemon = True
+        self._thread.start()
+    
+    def stop(self):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+    
+    def stats(self):
+        return {
+            'notifications': self.notifications,
+            'reconnects': self.reconnects,
+        }
+    
+    def _run(self):
+        first = True
+        while not self._stopping.is_set():
+            try:
+                conn = self._listen()
+            except psycopg2.Error:
+                self._stopping.wait(self.reconnect_interval)
+                continue
+            if not first:
+                self.reconnects += 1
+                self.cache.clear()
+            first = False
+            try:
+                self._receive(conn)
+            except psycopg2.Error:
+                pass
+            finally:
+                try:
+                    conn.close()
+                except psycopg2.Error:
+                    pass
+    
+    def _listen(self):
+        conn = psycopg2.connect(self.dsn)
+        conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        cursor = conn.cursor()
+        cursor.execute('listen "%s"' % self.channel.replace('"', '""'))
+        cursor.close()
+        return conn
+    
+    def _receive(self, conn):
+        while not self._stopping.is_set():
+            if select.select([conn], [], [], self.poll_interval) == ([], [], []):
+                continue
+            conn.poll()
+            while conn.notifies:
+                notify = conn.notifies.pop(0)
+                self.notifications += 1
+                # tg_table_name is the exact, case-sensitive name
+                self.cache.invalidate_table('"%s"' % notify.payload)
@@ -0,0 +1,98 @@
+'''Batched loading of rows by key.
+
+A RowLoader collects keys wanted by code running within one scope, such
+as a web request, and loads all pending keys of a table with a single
+query when one of them is needed, instead of one query per key. Loaded
+rows are memoized for the lifetime of the loader.
+'''
+
+from .dbwrap import NotFoundError, SchemaName, SqlArray
+
+class RowLoader(object):
+    '''Loads rows of tables by the value of a key column, by default id.
+    
+    Keys must have the python type the database returns for the column,
+    e.g. ints for integer ids, as they are matched against loaded rows.
+    The rows are those CursorWrapper.one_check would return for
+    'select * from table where column = ?'.
+    '''
+    
+    def __init__(self, cursor, max_batch=1000):
+        self.cursor = cursor
+        self.max_batch = max_batch
+        # (table, column) -> key -> row, or None for missing rows
+        self._memo = {}
+        # (table, column) -> keys to load with the next query
+        self._pending = {}
+        self.queries = 0
+    
+    def want(self, table, keys, column='id'):
+        '''Adds keys to be loaded with the next query for table.'''
+        
+        memo = self._memo.setdefault((table, column), {})
+        pending = self._pending.setdefault((table, column), [])
+        for key in keys:
+            if key not in memo:
+                pending.append(key)
+    
+    def load(self, table, key, column='id'):
+        '''Returns the row with the given key, raising NotFoundError if
+        there is none.'''
+        
+        row = self.get(table, key, column)
+        if row is None:
+            raise NotFoundError("No data %s" % repr((key,)))
+        return row
+    
+    def get(self, table, key, column='id'):
+        '''Returns the row with the given key or None.'''
+        
+        memo = self._memo.get((table, column))
+        if memo is None or key not in memo:
+            self.want(table, [key], column)
+            self._resolve(table, column)
+            memo = self._memo[(table, column)]
+        return memo[key]
+    
+    def load_many(self, table, keys, column='id'):
+        '''Returns the rows with the given keys in the same order,
+        raising NotFoundError if any of them is missing.'''
+        
+        keys = list(keys)
+        self.want(table, keys, column)
+        return [self.load(table, key, column) for key in keys]
+    
+    def forget(self, table, key=None, column='id'):
+        '''Drops memoized rows of table, or only the row with key.'''
+        
+        memo = self._memo.get((table, column))
+        if memo is None:
+            return
+        if key is None:
+            memo.clear()
+        else:
+            memo.pop(key, None)
+    
+    def clear(self):
+        self._memo.clear()
+        self._pending.clear()
+    
+    def _resolve(self, table, column):
+        memo = self._memo[(table, column)]
+        pending = self._pending.pop((table, column), [])
+        keys = []
+        seen = set()
+        for key in pending:
+            if key not in memo and key not in seen:
+                seen.add(key)
+                keys.append(key)
+        for start in range(0, len(keys), self.max_batch):
+            batch = keys[start:start + self.max_batch]
+            rows = self.cursor.all('select * from %s where %s = any(%s)',
+                SchemaName(table), SchemaName(column), SqlArray(batch))
+            self.queries += 1
+            for row in rows:
+                memo[row[column]] = row
+            for key in batch:
+                if key not in memo:
+                    memo[key] = None
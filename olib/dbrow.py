@@ -0,0 +1,134 @@
+'''Compact rows for query results.
+
+A row is an instance of a tuple subclass generated once per distinct
+list of column names. Like dtuple.DatabaseTuple it supports indexing,
+mapping-style access by column name and attribute access, but it carries
+no per-row dictionary and resolves column names through a mapping
+shared by all rows of its class.
+'''
+
+import re
+
+try:
+    basestring
+except NameError:
+    # python 3
+    basestring = str
+
+_tuple_getitem = tuple.__getitem__
+
+_IDENTIFIER_REGEXP = re.compile(r'^[A-Za-z][A-Za-z0-9_]*$')
+
+# names that always refer to methods, as with DatabaseTuple
+_RESERVED_NAMES = frozenset(['asMapping', 'asTuple', 'asList'])
+
+class Row(tuple):
+    '''Base class of generated row classes.
+    
+    Columns named like methods of this class (keys, items, count, etc.)
+    are returned by attribute access in preference to the methods, use
+    asMapping() or asList() to get at the methods in that case.
+    '''
+    
+    __slots__ = ()
+    
+    # set by row_class
+    _names_ = ()
+    _namemap_ = {}
+    
+    def __getitem__(self, key):
+        # integer keys are not in the name map and are passed through
+        try:
+            return _tuple_getitem(self, self._namemap_.get(key, key))
+        except TypeError:
+            if isinstance(key, slice):
+                return _tuple_getitem(self, key)
+            raise KeyError(key)
+    
+    def __repr__(self):
+        values = ['%s=%s' % (name, repr(value))
+            for name, value in zip(self._names_, self)]
+        return 'Row(%s)' % ', '.join(values)
+    
+    def __reduce__(self):
+        return (_make_row, (self._names_, tuple(self)))
+    
+    def get(self, key, default=None):
+        index = self._namemap_.get(key)
+        if index is None:
+            return default
+        return _tuple_getitem(self, index)
+    
+    def keys(self):
+        return list(self._names_)
+    
+    def values(self):
+        return list(self)
+    
+    def items(self):
+        return list(zip(self._names_, self))
+    
+    def has_key(self, key):
+        return key in self._namemap_
+    
+    def asMapping(self):
+        return dict(zip(self._names_, self))
+    
+    # munged rows replace PropertyDict, which has a dict method
+    dict = asMapping
+    
+    def asTuple(self):
+        return tuple(self)
+    
+    def asList(self):
+        return list(self)
+
+def _make_row_class(names):
+    namemap = {}
+    for index, name in enumerate(names):
+        namemap[name] = index
+    attrs = {
+        '__slots__': (),
+        '_names_': names,
+        '_namemap_': namemap,
+    }
+    for name, index in namemap.items():
+        if not isinstance(name, str):
+            # unicode column names on python 2
+            try:
+                name = name.encode('ascii')
+            except UnicodeError:
+                continue
+        if _IDENTIFIER_REGEXP.match(name) and name not in _RESERVED_NAMES:
+            attrs[name] = _column_property(index)
+    return type('Row', (Row,), attrs)
+
+# operator.itemgetter would go through Row.__getitem__
+def _column_property(index):
+    return property(lambda self: _tuple_getitem(self, index))
+
+# generated classes keyed by tuples of column names
+_row_classes = {}
+
+# like the re module's pattern cache, the class cache is emptied when it
+# grows past this size
+MAX_ROW_CLASSES = 500
+
+def row_class(names):
+    '''Returns the row class for the given column names.'''
+    
+    names = tuple(names)
+    cls = _row_classes.get(names)
+    if cls is None:
+        if len(_row_classes) >= MAX_ROW_CLASSES:
+            _row_classes.clear()
+        cls = _row_classes[names] = _make_row_class(names)
+    return cls
+
+def description_row_class(description):
+    '''Returns the row class for a DB-API cursor description.'''
+    
+    return row_class([column[0] for column in description])
+
+def _make_row(names, values):
+    return row_class(names)(values)
@@ -0,0 +1,377 @@
+'''Query instrumentation.
+
+Observers are registered on a dbwrap.ConnectionWrapper with add_observer
+(or on a single CursorWrapper) and are called after every statement
+executed through execute2, at the end of outermost transactions and on
+reconnects. QueryStats is an observer aggregating latency histograms per
+statement shape that is cheap enough to leave enabled. SlowQueryLog
+records statements exceeding a time threshold together with their plans.
+NPlusOneDetector flags statements repeated in a loop.
+'''
+
+import bisect
+import collections
+import json
+import logging
+import os.path
+import psycopg2
+import re
+import sys
+import threading
+import time
+import traceback
+
+class QueryObserver(object):
+    '''Base class for observers, override the hooks of interest.'''
+    
+    def on_query(self, cursor, sql, args, duration, rowcount, error):
+        '''Called after a statement is executed on cursor, a CursorWrapper.
+        
+        duration is in seconds. error is the exception raised by the
+        statement, in which case rowcount is None.
+        '''
+    
+    def on_transaction(self, conn, duration, committed):
+        '''Called when an outermost transaction on conn, a
+        ConnectionWrapper, is committed or rolled back.'''
+    
+    def on_reconnect(self, conn):
+        '''Called after conn, a ConnectionWrapper, reconnects.'''
+    
+    def on_retry(self, conn, error, attempt):
+        '''Called before run_in_transaction on conn retries a transaction
+        that failed with error. attempt counts from 1.'''
+
+_STRING_REGEXP = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_REGEXP = re.compile(r'\b\d+(?:\.\d+)?\b')
+_PLACEHOLDER_REGEXP = re.compile(r'%(?:\(\w+\))?s|\$\d+|\?')
+_LIST_REGEXP = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+_WHITESPACE_REGEXP = re.compile(r'\s+')
+
+_shapes = {}
+
+# like the re module's pattern cache, the shape memo is emptied
+# when it grows past this size
+MAX_SHAPES = 1000
+
+def sql_shape(sql):
+    '''Reduces a statement to its shape: literals and placeholders are
+    replaced with ?, lists of them with (...), and whitespace collapsed.
+    Statements differing only in their parameters have the same shape.'''
+    
+    shape = _shapes.get(sql)
+    if shape is None:
+        shape = _STRING_REGEXP.sub('?', sql)
+        shape = _PLACEHOLDER_REGEXP.sub('?', shape)
+        shape = _NUMBER_REGEXP.sub('?', shape)
+        shape = _LIST_REGEXP.sub('(...)', shape)
+        shape = _WHITESPACE_REGEXP.sub(' ', shape).strip()
+        if len(_shapes) >= MAX_SHAPES:
+            _shapes.clear()
+        _shapes[sql] = shape
+    return shape
+
+# upper bounds of histogram buckets in seconds, the last bucket is unbounded
+BUCKETS = [
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+]
+
+class Histogram(object):
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+    
+    def add(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+    
+    def percentile(self, fraction):
+        '''Returns the upper bound of the bucket holding the given
+        fraction of values, or the maximum for the last bucket.'''
+        
+        if not self.count:
+            return None
+        target = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                if index < len(BUCKETS):
+                    return min(BUCKETS[index], self.max)
+                break
+        return self.max
+    
+    def snapshot(self):
+        if self.count:
+            mean = self.total / self.count
+        else:
+            mean = None
+        return {
+            'count': self.count,
+            'total': self.total,
+            'mean': mean,
+            'max': self.max,
+            'p50': self.percentile(0.5),
+            'p95': self.percentile(0.95),
+            'p99': self.percentile(0.99),
+            'buckets': list(self.counts),
+        }
+
+class _ShapeStats(object):
+    __slots__ = ['latency', 'rows', 'errors']
+    
+    def __init__(self):
+        self.latency = Histogram()
+        self.rows = 0
+        self.errors = 0
+
+class QueryStats(QueryObserver):
+    '''In-memory aggregator of statement latencies per statement shape,
+    transaction durations and reconnects.'''
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+    
+    def reset(self):
+        with self._lock:
+            self._shapes = {}
+            self._transactions = Histogram()
+            self._rollbacks = 0
+            self._reconnects = 0
+            self._retries = 0
+    
+    def on_query(self, cursor, sql, args, duration, rowcount, error):
+        shape = sql_shape(sql)
+        with self._lock:
+            stats = self._shapes.get(shape)
+            if stats is None:
+                stats = self._shapes[shape] = _ShapeStats()
+            stats.latency.add(duration)
+            if error is not None:
+                stats.errors += 1
+            elif rowcount is not None and rowcount > 0:
+                stats.rows += rowcount
+    
+    def on_transaction(self, conn, duration, committed):
+        with self._lock:
+            self._transactions.add(duration)
+            if not committed:
+                self._rollbacks += 1
+    
+    def on_reconnect(self, conn):
+        with self._lock:
+            self._reconnects += 1
+    
+    def on_retry(self, conn, error, attempt):
+        with self._lock:
+            self._retries += 1
+    
+    def snapshot(self):
+        '''Returns the collected statistics as a dictionary.'''
+        
+        with self._lock:
+            queries = {}
+            for shape, stats in self._shapes.items():
+                snapshot = stats.latency.snapshot()
+                snapshot['rows'] = stats.rows
+                snapshot['errors'] = stats.errors
+                queries[shape] = snapshot
+            return {
+                'queries': queries,
+                'transactions': self._transactions.snapshot(),
+                'rollbacks': self._rollbacks,
+                'reconnects': self._reconnects,
+                'retries': self._retries,
+            }
+    
+    def dump(self, file=None, limit=None):
+        '''Writes a report of statement shapes by total time to file,
+        standard output by default.'''
+        
+        if file is None:
+            file = sys.stdout
+        snapshot = self.snapshot()
+        queries = sorted(snapshot['queries'].items(),
+            key=lambda item: item[1]['total'], reverse=True)
+        if limit is not None:
+            queries = queries[:limit]
+        for shape, stats in queries:
+            file.write('%8d calls %10.3fs total %8.2fms mean %8.2fms p95 %8.2fms max %6d errors  %s\n' % (
+                stats['count'], stats['total'], stats['mean'] * 1000,
+                stats['p95'] * 1000, stats['max'] * 1000, stats['errors'],
+                shape,
+            ))
+        transactions = snapshot['transactions']
+        if transactions['count']:
+            file.write('%8d transactions %10.3fs total %8.2fms mean %8.2fms p95, %d rolled back\n' % (
+                transactions['count'], transactions['total'],
+                transactions['mean'] * 1000, transactions['p95'] * 1000,
+                snapshot['rollbacks'],
+            ))
+        file.write('%8d reconnects\n' % snapshot['reconnects'])
+        file.write('%8d retries\n' % snapshot['retries'])
+
+_PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def call_site():
+    '''Returns "file:line in function" of the innermost stack frame
+    outside of the database modules of this package.'''
+    
+    for filename, line, function, text in reversed(traceback.extract_stack()):
+        if os.path.dirname(os.path.abspath(filename)) == _PACKAGE_DIR and \
+            os.path.basename(filename).startswith('db') \
+        :
+            continue
+        return '%s:%d in %s' % (filename, line, function)
+    return None
+
+_EXPLAINABLE_REGEXP = re.compile(r'^\s*(select|insert|update|delete|values|with)\b', re.I)
+_READ_ONLY_REGEXP = re.compile(r'^\s*(select|values)\b', re.I)
+_LOCKING_REGEXP = re.compile(r'\bfor\s+(update|no\s+key\s+update|share|key\s+share)\b', re.I)
+
+class SlowQueryLog(QueryObserver):
+    '''Records statements taking at least threshold seconds.
+    
+    Each record holds the statement, its arguments, duration, row count,
+    error, call site and plan, obtained by running EXPLAIN (FORMAT JSON)
+    on the statement's connection after it completes. If analyze is true
+    read-only statements are explained with ANALYZE, which executes them
+    again. Records are kept in a ring buffer of max_records entries, and
+    appended as JSON lines to path if given.
+    '''
+    
+    def __init__(self, threshold=1, max_records=100, path=None,
+        explain=True, analyze=False,
+    ):
+        self.threshold = threshold
+        self.path = path
+        self.explain = explain
+        self.analyze = analyze
+        self._records = collections.deque(maxlen=max_records)
+        self._lock = threading.Lock()
+    
+    def on_query(self, cursor, sql, args, duration, rowcount, error):
+        if duration < self.threshold:
+            return
+        if args is None:
+            logged_args = None
+        elif isinstance(args, dict):
+            logged_args = dict([(key, repr(value)) for key, value in args.items()])
+        else:
+            logged_args = [repr(arg) for arg in args]
+        record = {
+            'time': time.time(),
+            'sql': sql,
+            'args': logged_args,
+            'duration': duration,
+            'rowcount': rowcount,
+            'error': error is not None and str(error) or None,
+            'call_site': call_site(),
+            'plan': None,
+        }
+        # a failed statement has aborted the transaction, and a script
+        # of several statements (args is None) cannot be explained
+        if self.explain and error is None and args is not None and \
+            _EXPLAINABLE_REGEXP.match(sql) \
+        :
+            record['plan'] = self._explain(cursor.conn.conn, sql, args)
+        with self._lock:
+            self._records.append(record)
+            if self.path is not None:
+                with open(self.path, 'a') as file:
+                    file.write(json.dumps(record, default=repr) + '\n')
+    
+    def _explain(self, conn, sql, args):
+        if self.analyze and _READ_ONLY_REGEXP.match(sql) and \
+            not _LOCKING_REGEXP.search(sql) \
+        :
+            options = 'analyze, format json'
+        else:
+            options = 'format json'
+        # a failing explain must not abort the caller's transaction
+        savepoint = not conn.autocommit
+        cursor = conn.cursor()
+        try:
+            if savepoint:
+                cursor.execute('savepoint olib_explain')
+            try:
+                cursor.execute('explain (%s) %s' % (options, sql), args)
+                plan = cursor.fetchone()[0]
+            except psycopg2.Error as e:
+                if savepoint:
+                    cursor.execute('rollback to savepoint olib_explain')
+                plan = {'error': str(e).strip()}
+            if savepoint:
+                cursor.execute('release savepoint olib_explain')
+            return plan
+        except psycopg2.Error:
+            return None
+        finally:
+            cursor.close()
+    
+    def records(self):
+        '''Returns the recorded statements, oldest first.'''
+        
+        with self._lock:
+            return list(self._records)
+    
+    def clear(self):
+        with self._lock:
+            self._records.clear()
+
+class NPlusOneDetector(QueryObserver):
+    '''Detects statements of one shape executed more than threshold
+    times with different arguments, which usually come from a loop that
+    could be replaced by a single statement.
+    
+    action is 'raise' to raise dbwrap.NPlusOneError from the offending
+    statement or 'log' to log a warning. Each shape is reported once.
+    '''
+    
+    def __init__(self, threshold=10, action='raise', logger=None):
+        if action not in ('raise', 'log'):
+            raise ValueError('Unknown action: %s' % action)
+        self.threshold = threshold
+        self.action = action
+        self.logger = logger or logging.getLogger(__name__)
+        self.reset()
+    
+    def reset(self):
+        # shape -> set of argument reprs
+        self._arguments = {}
+        # shape -> Counter of call sites
+        self._call_sites = {}
+        self._reported = set()
+    
+    def on_query(self, cursor, sql, args, duration, rowcount, error):
+        shape = sql_shape(sql)
+        arguments = self._arguments.get(shape)
+        if arguments is None:
+            arguments = self._arguments[shape] = set()
+            self._call_sites[shape] = collections.Counter()
+        arguments.add(repr(args))
+        self._call_sites[shape][call_site()] += 1
+        if len(arguments) > self.threshold and shape not in self._reported:
+            self._reported.add(shape)
+            self.report(shape)
+    
+    def report(self, shape):
+        message = self.describe(shape)
+        if self.action == 'raise':
+            from .dbwrap import NPlusOneError
+            raise NPlusOneError(message)
+        self.logger.warning(message)
+    
+    def describe(self, shape):
+        lines = ['Statement executed with %d different arguments: %s' % (
+            len(self._arguments[shape]), shape)]
+        for site, count in self._call_sites[shape].most_common():
+            lines.append('    %dx at %s' % (count, site))
+        return '\n'.join(lines)
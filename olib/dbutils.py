@@ -4,10 +4,7 @@ def pivot(rows, column):
     within the row list, later rows will overwrite earlier rows with the same
     key.'''
     
-    map = {}
-    for row in rows:
-        map[row[column]] = row
-    return map
+    return ResultSet(rows).unique_index(column)
 
 def pivot_value(rows, column):
     '''Transforms a list of rows into a dictionary. The specified column
@@ -15,37 +12,452 @@ def pivot_value(rows, column):
     columns. The value of the other column becomes the value in the
     dictionary. Later values will overwrite earlier values with the same key.'''
     
-    map = {}
-    if len(rows) == 0:
-        return map
-    keys = rows[0].keys()
+    result_set = ResultSet(rows)
+    if len(result_set) == 0:
+        return {}
+    keys = result_set.rows[0].keys()
     value_column = [key for key in keys if key != column][0]
-    for row in rows:
-        map[row[column]] = row[value_column]
-    return map
+    return dict(zip(result_set.column(column), result_set.column(value_column)))
 
 def pivot_multi(rows, *columns):
-    map = {}
-    for row in rows:
-        this_map = map
-        for column in columns[:-1]:
-            value = row[column]
-            if not this_map.has_key(value):
-                this_map[value] = {}
-            this_map = this_map[value]
-        this_map[row[columns[-1]]] = row
-    return map
+    return ResultSet(rows).multi_index(*columns)
 
 def pivot_lists(rows, column):
-    map = {}
+    return ResultSet(rows).group_index(column)
+
+def iter_pivot_lists(rows, column, max_rows=100000, partitions=16, tempdir=None):
+    '''Groups rows by column like pivot_lists, yielding (key, list of
+    rows) pairs, while holding at most about max_rows rows in memory.
+    
+    rows can be any iterable, such as CursorWrapper.iter_all. As long as
+    it has at most max_rows rows groups are yielded in order of first
+    appearance. Otherwise rows are spilled by hash of their key to
+    partition files in tempdir, which are grouped one at a time and
+    yielded in no particular order. Rows keep their order within groups.
+    Each group must fit in memory, and rows must be picklable.
+    
+    column can be a tuple of columns, keys are then tuples of values.
+    '''
+    
+    if isinstance(column, tuple):
+        columns = column
+        key_of = lambda row: tuple([row[column] for column in columns])
+    else:
+        key_of = lambda row: row[column]
+    
+    rows = iter(rows)
+    keys = []
+    groups = {}
+    count = 0
     for row in rows:
-        key = row[column]
-        mapped_row = map.get(key)
-        if mapped_row is None:
-            mapped_row = []
-            map[key] = mapped_row
-        mapped_row.append(row)
-    return map
+        key = key_of(row)
+        group = groups.get(key)
+        if group is None:
+            keys.append(key)
+            groups[key] = [row]
+        else:
+            group.append(row)
+        count += 1
+        if count > max_rows:
+            break
+    else:
+        for key in keys:
+            yield key, groups[key]
+        return
+    
+    spill = _Spill(partitions, 0, tempdir)
+    try:
+        for key in keys:
+            for row in groups[key]:
+                spill.add(key, row)
+        del keys, groups
+        for row in rows:
+            spill.add(key_of(row), row)
+        for key, group in spill.groups(max_rows):
+            yield key, group
+    finally:
+        spill.close()
+
+# partitions below this depth are split further when they exceed the
+# row budget, past it they are grouped in memory regardless
+_MAX_SPILL_DEPTH = 3
+
+class _Spill(object):
+    '''(key, row) records hash partitioned into temporary files.'''
+    
+    def __init__(self, partitions, depth, tempdir):
+        self.depth = depth
+        self.tempdir = tempdir
+        self.files = [tempfile.TemporaryFile(dir=tempdir) for index in range(partitions)]
+        self.counts = [0] * partitions
+        self.picklers = [pickle.Pickler(file, pickle.HIGHEST_PROTOCOL) for file in self.files]
+    
+    def add(self, key, row):
+        # the depth varies the hash so that repartitioning splits keys
+        index = hash((self.depth, key)) % len(self.files)
+        pickler = self.picklers[index]
+        pickler.dump((key, row))
+        # picklers memoize objects, which would keep every row alive
+        pickler.clear_memo()
+        self.counts[index] += 1
+    
+    def records(self, index):
+        file = self.files[index]
+        file.seek(0)
+        for record in range(self.counts[index]):
+            # each record was pickled with a fresh memo and needs a
+            # fresh unpickler, references would otherwise resolve to
+            # objects of earlier records
+            yield pickle.load(file)
+    
+    def groups(self, max_rows):
+        for index in range(len(self.files)):
+            if self.counts[index] > max_rows and self.depth < _MAX_SPILL_DEPTH:
+                spill = _Spill(len(self.files), self.depth + 1, self.tempdir)
+                try:
+                    for key, row in self.records(index):
+                        spill.add(key, row)
+                    self._drop(index)
+                    for group in spill.groups(max_rows):
+                        yield group
+                finally:
+                    spill.close()
+                continue
+            groups = {}
+            for key, row in self.records(index):
+                group = groups.get(key)
+                if group is None:
+                    groups[key] = [row]
+                else:
+                    group.append(row)
+            self._drop(index)
+            for item in groups.items():
+                yield item
+    
+    def _drop(self, index):
+        self.files[index].close()
+        self.counts[index] = 0
+    
+    def close(self):
+        for file in self.files:
+            file.close()
+
+_tuple_getitem = tuple.__getitem__
+
+class ResultSet(object):
+    '''Indexes over a list of rows, as returned by CursorWrapper.all.
+    
+    Column values are extracted by position once per column, for rows
+    whose class describes their columns (dbrow.Row and
+    dtuple.DatabaseTuple) if all rows share one description, and by
+    name otherwise. Indexes are built on
+    first use and cached, they must not be modified by callers. Keys of
+    indexes on several columns are tuples of column values.
+    
+    rows can be any iterable, other than lists and tuples it is read
+    into a list. The rows must not be changed after the result set is
+    created.
+    '''
+    
+    def __init__(self, rows):
+        if not isinstance(rows, (list, tuple)):
+            rows = list(rows)
+        self.rows = rows
+        self._columns = {}
+        self._indexes = {}
+    
+    def __len__(self):
+        return len(self.rows)
+    
+    def __iter__(self):
+        return iter(self.rows)
+    
+    def column(self, column):
+        '''Returns the list of values of column.'''
+        
+        values = self._columns.get(column)
+        if values is None:
+            values = self._columns[column] = self._extract(column)
+        return values
+    
+    def keys(self, columns):
+        '''Returns the list of index keys for a sequence of columns.'''
+        
+        if len(columns) == 1:
+            return self.column(columns[0])
+        return list(zip(*[self.column(column) for column in columns]))
+    
+    def _extract(self, column):
+        rows = self.rows
+        if not rows:
+            return []
+        first = rows[0]
+        # rows concatenated from several queries can have the column in
+        # different positions, positions are only used if they all
+        # share the first row's description
+        namemap = getattr(first, '_namemap_', None)
+        if namemap is not None and column in namemap:
+            row_class = first.__class__
+            if all([row.__class__ is row_class for row in rows]):
+                position = namemap[column]
+                return list(map(_tuple_getitem, rows, itertools.repeat(position, len(rows))))
+        desc = getattr(first, '_desc_', None)
+        if desc is not None and column in desc.namemap:
+            if all([getattr(row, '_desc_', None) is desc for row in rows]):
+                position = desc.namemap[column]
+                return [row._data_[position] for row in rows]
+        return [row[column] for row in rows]
+    
+    def _index(self, kind, columns, build):
+        key = (kind, columns)
+        index = self._indexes.get(key)
+        if index is None:
+            index = self._indexes[key] = build(columns)
+        return index
+    
+    def unique_index(self, *columns):
+        '''Returns a dict mapping keys to rows, later rows overwriting
+        earlier rows with the same key.'''
+        
+        return self._index('unique', columns,
+            lambda columns: dict(zip(self.keys(columns), self.rows)))
+    
+    def group_index(self, *columns):
+        '''Returns a dict mapping keys to lists of rows in their original
+        order.'''
+        
+        return self._index('group', columns, self._group)
+    
+    def _group(self, columns):
+        groups = {}
+        for key, row in zip(self.keys(columns), self.rows):
+            group = groups.get(key)
+            if group is None:
+                groups[key] = [row]
+            else:
+                group.append(row)
+        return groups
+    
+    def multi_index(self, *columns):
+        '''Returns nested dicts keyed by the values of each column in
+        turn, the innermost mapping to rows as in unique_index.'''
+        
+        return self._index('multi', columns, self._multi)
+    
+    def _multi(self, columns):
+        map = {}
+        values = [self.column(column) for column in columns]
+        for keys, row in zip(zip(*values), self.rows):
+            this_map = map
+            for key in keys[:-1]:
+                next_map = this_map.get(key)
+                if next_map is None:
+                    next_map = this_map[key] = {}
+                this_map = next_map
+            this_map[keys[-1]] = row
+        return map
+    
+    def get(self, columns, key, default=None):
+        '''Returns the row with the given key, columns being a column
+        name or a tuple of column names.'''
+        
+        if not isinstance(columns, tuple):
+            columns = (columns,)
+        return self.unique_index(*columns).get(key, default)
+    
+    def get_all(self, columns, key):
+        '''Returns the list of rows with the given key.'''
+        
+        if not isinstance(columns, tuple):
+            columns = (columns,)
+        return self.group_index(*columns).get(key, [])
+
+# Joins and aggregation over lists of rows or ResultSets. Columns are
+# given as a name or a tuple of names for composite keys.
+
+def _result_set(rows):
+    if isinstance(rows, ResultSet):
+        return rows
+    return ResultSet(rows)
+
+def _key_columns(columns):
+    if isinstance(columns, tuple):
+        return columns
+    return (columns,)
+
+# as in sql, keys that are or contain null match nothing. Returns index,
+# a dict keyed by keys of columns, without such keys; cached indexes are
+# copied rather than modified.
+def _without_null_keys(index, columns):
+    if len(columns) == 1:
+        if None not in index:
+            return index
+        nulls = [None]
+    else:
+        nulls = [key for key in index if None in key]
+        if not nulls:
+            return index
+    index = dict(index)
+    for key in nulls:
+        del index[key]
+    return index
+
+def hash_join(left, right, on, right_on=None, how='inner'):
+    '''Joins two lists of rows on equal values of the on columns of left
+    and the right_on columns (by default the same) of right.
+    
+    Returns a list of (left row, right row) pairs in the order of left.
+    With how='left' left rows without a match are paired with None. As
+    in SQL, keys that are or contain null match nothing.
+    '''
+    
+    if how not in ('inner', 'left'):
+        raise ValueError('Unknown join type: %s' % how)
+    left = _result_set(left)
+    right = _result_set(right)
+    left_columns = _key_columns(on)
+    if right_on is None:
+        right_columns = left_columns
+    else:
+        right_columns = _key_columns(right_on)
+    outer = how == 'left'
+    unique = right.unique_index(*right_columns)
+    if len(unique) == len(right):
+        unique = _without_null_keys(unique, right_columns)
+        # at most one match per left row, pair up without a python loop
+        matches = list(map(unique.get, left.keys(left_columns)))
+        pairs = zip(left.rows, matches)
+        if outer:
+            return list(pairs)
+        # matched rows have a key column and are never empty
+        return list(itertools.compress(pairs, matches))
+    
+    groups = _without_null_keys(right.group_index(*right_columns), right_columns)
+    # pair each left row with each of its matches without a python loop,
+    # a left row without matches is paired with [None] in left joins
+    if outer:
+        missing = [None]
+    else:
+        missing = ()
+    matches = map(groups.get, left.keys(left_columns), itertools.repeat(missing))
+    return list(itertools.chain.from_iterable(
+        map(zip, map(itertools.repeat, left.rows), matches)))
+
+def semi_join(left, right, on, right_on=None, anti=False):
+    '''Returns the rows of left having a match in right, or with
+    anti=True the rows having none, like EXISTS and NOT EXISTS
+    subqueries. Keys that are or contain null match nothing.'''
+    
+    left = _result_set(left)
+    right = _result_set(right)
+    left_columns = _key_columns(on)
+    if right_on is None:
+        right_columns = left_columns
+    else:
+        right_columns = _key_columns(right_on)
+    keys = set(right.keys(right_columns))
+    if len(right_columns) == 1:
+        keys.discard(None)
+    else:
+        keys = set([key for key in keys if None not in key])
+    if anti:
+        return [row for key, row in zip(left.keys(left_columns), left.rows)
+            if key not in keys]
+    return [row for key, row in zip(left.keys(left_columns), left.rows)
+        if key in keys]
+
+def _aggregate_count(values):
+    return len(values)
+
+def _aggregate_avg(values):
+    if not values:
+        return None
+    total = sum(values)
+    if isinstance(total, numbers.Integral):
+        # no integer division on python 2
+        total = float(total)
+    return total / len(values)
+
+def _aggregate_or_none(function):
+    def aggregate(values):
+        if not values:
+            return None
+        return function(values)
+    return aggregate
+
+_AGGREGATES = {
+    'count': _aggregate_count,
+    'sum': _aggregate_or_none(sum),
+    'min': _aggregate_or_none(min),
+    'max': _aggregate_or_none(max),
+    'avg': _aggregate_avg,
+    'list': list,
+}
+
+# as in sql nulls are left out of aggregated values
+def _without_nulls(values):
+    if None in values:
+        return [value for value in values if value is not None]
+    return values
+
+def group_by(rows, columns, aggregates):
+    '''Groups rows by columns and computes aggregates of each group.
+    
+    aggregates is a sequence of (name, function, column) where function
+    is one of count, sum, min, max, avg and list, or a callable taking a
+    list of values. As in SQL nulls are left out of the values, and a
+    None column counts rows. Returns a list of dbrow rows with the group
+    columns followed by the aggregates, in order of first appearance of
+    each group.
+    '''
+    
+    rows = _result_set(rows)
+    columns = _key_columns(columns)
+    # one pass collects the values of the aggregated columns per group,
+    # as tuples if there are several columns
+    value_columns = []
+    for name, function, column in aggregates:
+        if column is not None and column not in value_columns:
+            value_columns.append(column)
+    if len(value_columns) == 1:
+        items = rows.column(value_columns[0])
+    elif value_columns:
+        items = zip(*[rows.column(column) for column in value_columns])
+    else:
+        items = itertools.repeat(None, len(rows))
+    keys = []
+    groups = {}
+    for key, item in zip(rows.keys(columns), items):
+        group = groups.get(key)
+        if group is None:
+            keys.append(key)
+            groups[key] = [item]
+        else:
+            group.append(item)
+    groups = list(map(groups.get, keys))
+    if len(value_columns) > 1:
+        values = list(zip(*[list(map(list, zip(*group))) for group in groups]))
+    else:
+        values = [groups]
+    
+    computed = []
+    for name, function, column in aggregates:
+        if not callable(function):
+            function = _AGGREGATES[function]
+        if column is None:
+            computed.append(list(map(function, groups)))
+        else:
+            lists = values[value_columns.index(column)]
+            computed.append(list(map(function, map(_without_nulls, lists))))
+    
+    if len(columns) == 1:
+        keys = [(key,) for key in keys]
+    row_class = dbrow.row_class(columns + tuple([aggregate[0] for aggregate in aggregates]))
+    if computed:
+        computed = zip(*computed)
+    else:
+        computed = itertools.repeat(())
+    return [row_class(key + results) for key, results in zip(keys, computed)]
 
 def split_row_map(row, map):
     if len(map) == 0:
@@ -59,8 +471,8 @@ def split_row_map(row, map):
         found = False
         try:
             value = row[key]
-        except IndexError, e:
-            raise IndexError, '%s: %s' % (e.message, key)
+        except IndexError as e:
+            raise IndexError('%s: %s' % (e, key))
         for prefix in map:
             if key.startswith(prefix):
                 adjusted_key = key[len(prefix):]
@@ -91,7 +503,7 @@ class PropertyDict(object):
         try:
             return self.attrs[attr]
         except KeyError:
-            raise AttributeError, 'No such attribute: %s' % attr
+            raise AttributeError('No such attribute: %s' % attr)
     
     def __repr__(self):
         return 'PropertyDict(%s)' % repr(self.attrs)
@@ -121,13 +533,33 @@ def munge_row_map(row, map):
             base[map[key]] = value
     return PropertyDict(base)
 
+import collections
+import itertools
+import numbers
 import re
+import tempfile
 
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from . import dbrow
+
+try:
+    # python 2, lazy versions avoid building lists of a million tuples
+    from itertools import izip as zip, imap as map
+except ImportError:
+    pass
+
+_MUNGE_SQL_REGEXP = re.compile(r'^(\s*select\s+)(.+?)(\sfrom\s+(\w+)(?:.+)?)$', re.S + re.I)
+_MUNGE_COLUMN_REGEXP = re.compile(r'\b((\w+)s\.(\w+))(,|\s*$)')
+
+# dbwrap memoizes the result of this function per sql string
 def _munge_sql(sql):
-    regexp = re.compile(r'^(\s*select\s+)(.+?)(\sfrom\s+(\w+)(?:.+)?)$', re.S + re.I)
-    match = regexp.match(sql)
+    match = _MUNGE_SQL_REGEXP.match(sql)
     if not match:
-        raise ValueError, 'Sql did not match regexp'
+        raise ValueError('Sql did not match regexp')
     
     preamble = match.group(1)
     selects = match.group(2)
@@ -144,8 +576,151 @@ def _munge_sql(sql):
         tables[table + '_'] = mapped_value
         return match.group(1) + ' as ' + match.group(2) + '_' + match.group(3) + match.group(4)
     
-    selects = re.sub(r'\b((\w+)s\.(\w+))(,|\s*$)', replacer, selects)
+    selects = _MUNGE_COLUMN_REGEXP.sub(replacer, selects)
     
     return (preamble + selects + postamble, tables)
 
+# Lexical elements that can contain semicolons, and semicolons themselves.
+# Unterminated quotes extend to the end of the text.
+_SQL_TOKEN_REGEXP = re.compile(r'''
+    (?P<quoted>(?<![\w$])[eE]'(?:[^'\\]|\\.|'')*(?:'|\Z)
+        | '(?:[^']|'')*(?:'|\Z)
+        | "(?:[^"]|"")*(?:"|\Z))
+    | (?P<dollar>(?<![\w$])\$(?:[A-Za-z_][A-Za-z0-9_]*)?\$)
+    | (?P<line_comment>--[^\n]*)
+    | (?P<block_comment>/\*)
+    | (?P<semicolon>;)
+''', re.S + re.X)
+
+_BLOCK_COMMENT_REGEXP = re.compile(r'/\*|\*/')
+
+def _block_comment_end(sql, pos):
+    # block comments nest
+    depth = 1
+    while depth:
+        match = _BLOCK_COMMENT_REGEXP.search(sql, pos)
+        if match is None:
+            return len(sql)
+        if match.group() == '/*':
+            depth += 1
+        else:
+            depth -= 1
+        pos = match.end()
+    return pos
+
+def split_sql_statements(sql):
+    '''Splits a script into its statements, which are returned stripped
+    of surrounding whitespace. Semicolons in string literals, quoted
+    names, dollar-quoted strings and comments do not end statements.
+    Statements consisting of nothing but comments are dropped.'''
+    
+    statements = []
+    start = pos = 0
+    code = False
+    while True:
+        match = _SQL_TOKEN_REGEXP.search(sql, pos)
+        if match is None:
+            end = len(sql)
+        else:
+            end = match.start()
+        if not code and sql[pos:end].strip():
+            code = True
+        if match is None:
+            break
+        kind = match.lastgroup
+        if kind == 'semicolon':
+            if code:
+                statements.append(sql[start:end].strip())
+            start = pos = match.end()
+            code = False
+            continue
+        if kind == 'dollar':
+            tag = match.group()
+            pos = sql.find(tag, match.end())
+            if pos < 0:
+                pos = len(sql)
+            else:
+                pos += len(tag)
+        elif kind == 'block_comment':
+            pos = _block_comment_end(sql, match.end())
+        else:
+            pos = match.end()
+        if kind != 'line_comment' and kind != 'block_comment':
+            code = True
+    if code:
+        statements.append(sql[start:].strip())
+    return statements
+
 _munge_row = munge_row_map
+
+class MungePlan(object):
+    '''The result of munge_row_map for rows with given column names,
+    precomputed so that applying it to a row is a few list operations.
+    
+    apply takes a plain sequence of column values and returns a
+    dbrow.Row with one attribute per key munge_row_map would produce,
+    the mapped parts being rows themselves.
+    '''
+    
+    __slots__ = ['row_class', 'indexes', 'parts']
+    
+    def __init__(self, names, map):
+        # replicates split_row_map, iterating over columns in order;
+        # the dicts map keys to column indexes
+        base = collections.OrderedDict()
+        parts = {}
+        part_names = [map[prefix] for prefix in map if map[prefix] is not None]
+        for part in part_names:
+            parts[part] = collections.OrderedDict()
+        for index, key in enumerate(names):
+            found = False
+            for prefix in map:
+                if key.startswith(prefix):
+                    adjusted_key = key[len(prefix):]
+                    if map[prefix] is None:
+                        base[adjusted_key] = index
+                        found = True
+                    else:
+                        parts[map[prefix]][adjusted_key] = index
+                        found = True
+                        break
+            if not found:
+                base[key] = index
+        
+        base_names = list(base)
+        self.indexes = list(base.values())
+        self.parts = []
+        for part in part_names:
+            if part in base:
+                position = base_names.index(part)
+            else:
+                position = len(base_names)
+                base_names.append(part)
+                self.indexes.append(0)
+            self.parts.append((position, dbrow.row_class(parts[part]),
+                list(parts[part].values())))
+        self.row_class = dbrow.row_class(base_names)
+    
+    def apply(self, row):
+        values = [row[index] for index in self.indexes]
+        for position, part_class, indexes in self.parts:
+            values[position] = part_class([row[index] for index in indexes])
+        return self.row_class(values)
+
+_munge_plans = {}
+
+# like the re module's pattern cache, the plan cache is emptied when it
+# grows past this size
+MAX_MUNGE_PLANS = 500
+
+def munge_plan(names, map):
+    '''Returns the MungePlan for column names and a prefix map as
+    accepted by munge_row_map.'''
+    
+    key = (tuple(names), tuple(map.items()))
+    plan = _munge_plans.get(key)
+    if plan is None:
+        if len(_munge_plans) >= MAX_MUNGE_PLANS:
+            _munge_plans.clear()
+        plan = _munge_plans[key] = MungePlan(key[0], map)
+    return plan
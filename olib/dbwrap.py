@@ -1,7 +1,36 @@
+from __future__ import print_function
+
 import psycopg2, psycopg2.extras, psycopg2.extensions
+import array
+import base64
+import collections
+import datetime
+import decimal
+import io
+import itertools
+import json
+import math
+import random
 import re
+import threading
+import time
+import weakref
+
+from . import dbcache, dbrow, dbstats
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
-from . import dtuple
+try:
+    basestring
+except NameError:
+    # python 3
+    basestring = str
+    unicode = str
+    long = int
+    StandardError = Exception
 
 # Receive strings from the database in unicode
 # http://initd.org/psycopg/docs/usage.html#unicode-handling
@@ -58,59 +87,659 @@ class MissingCursorDescriptionError(DatabaseError):
 class DatabaseConnectionClosed(DatabaseError):
     pass
 
+class PoolTimeoutError(DatabaseError):
+    pass
+
+class PoolClosedError(DatabaseError):
+    pass
+
+class NPlusOneError(DatabaseError):
+    pass
+
+class StatementError(DatabaseError):
+    '''A statement of a script executed by execute_many failed.
+    
+    index is the position of the statement in the script, statement its
+    text and error the exception raised by the driver.
+    '''
+    
+    def __init__(self, index, statement, error):
+        DatabaseError.__init__(self, 'Statement %d failed: %s\n%s' % (
+            index + 1, str(error).strip(), statement))
+        self.index = index
+        self.statement = statement
+        self.error = error
+
+# server-side cursors need unique names
+_cursor_numbers = itertools.count()
+
 def _lists_to_tuples(arg):
-    if isinstance(arg, list):
+    # SqlArray is a list to be passed as an array
+    if isinstance(arg, list) and not isinstance(arg, SqlArray):
         arg = tuple(arg)
     return arg
 
+def _group_rows(rows):
+    '''Groups a list of dicts by their key sets. Returns a list of
+    (columns, row indexes) pairs in the order groups first appear.'''
+    
+    groups = {}
+    order = []
+    for index, row in enumerate(rows):
+        if not row:
+            raise ValueError('Cannot insert an empty dict')
+        key = frozenset(row)
+        group = groups.get(key)
+        if group is None:
+            group = groups[key] = (list(row.keys()), [])
+            order.append(key)
+        group[1].append(index)
+    return [groups[key] for key in order]
+
+_COPYABLE_TYPES = (
+    bool, int, long, float, decimal.Decimal, basestring,
+    datetime.date, datetime.time,
+)
+
+def _copyable(rows, columns):
+    for row in rows:
+        for column in columns:
+            value = row[column]
+            if value is None:
+                continue
+            if isinstance(value, (ExpressionValue, SchemaName)):
+                return False
+            if not isinstance(value, _COPYABLE_TYPES):
+                return False
+            if isinstance(value, float) and (math.isinf(value) or math.isnan(value)):
+                return False
+    return True
+
+_COPY_ESCAPES = [
+    (u'\\', u'\\\\'),
+    (u'\t', u'\\t'),
+    (u'\n', u'\\n'),
+    (u'\r', u'\\r'),
+]
+
+def _copy_text(value, encoding):
+    '''Formats value for COPY text format, returning a unicode string.'''
+    
+    if value is None:
+        return u'\\N'
+    if value is True:
+        return u't'
+    if value is False:
+        return u'f'
+    if isinstance(value, unicode):
+        pass
+    elif isinstance(value, str):
+        # python 2 byte string
+        value = value.decode(encoding)
+    elif isinstance(value, float):
+        value = unicode(repr(value))
+    elif isinstance(value, (datetime.date, datetime.time)):
+        value = unicode(value.isoformat())
+    else:
+        value = unicode(value)
+    for char, escape in _COPY_ESCAPES:
+        if char in value:
+            value = value.replace(char, escape)
+    return value
+
+# translates ? placeholders, normalizes args and munges sql
+def _prepare_query(sql, args, munge):
+    translated = _sql_cache.lookup(sql)
+    if munge:
+        sql, munge_mapping = translated.munged()
+    else:
+        sql = translated.sql
+        munge_mapping = None
+    
+    convert_lists = False
+    
+    if args is None:
+        args = ()
+    elif isinstance(args, dict):
+        # keep as a dict
+        # convert lists to tuples
+        for key in args:
+            value = args[key]
+            if isinstance(value, list):
+                args[key] = tuple(value)
+    elif isinstance(args, basestring) or getattr(args, '__len__', None) is None:
+        args = (args,)
+        convert_lists = True
+    else:
+        # a tuple or a list
+        convert_lists = True
+    
+    if convert_lists:
+        args = [_lists_to_tuples(arg) for arg in args]
+    
+    return sql, args, munge_mapping
+
+def _insert_dict_query(table, dict, return_id):
+    if not dict:
+        raise ValueError('Cannot insert an empty dict')
+    placeholders = ', '.join(['%s'] * len(dict))
+    sql = 'insert into %%s (%s) values (%s)' % (placeholders, placeholders)
+    if return_id:
+        sql += ' returning (id)'
+    table = SchemaName(table)
+    columns = [SchemaName(column) for column in dict.keys()]
+    values = list(dict.values())
+    args = [table] + columns + values
+    return sql, args
+
+def _update_query(table, attrs, conditions):
+    if not attrs:
+        raise ValueError('Trying to update with an empty attrs')
+    placeholders = ', '.join(['%s=%s'] * len(attrs))
+    sql = 'update %s set ' + placeholders
+    args = [SchemaName(table)]
+    for key in attrs:
+        args.append(SchemaName(key))
+        args.append(attrs[key])
+    if conditions is not None:
+        sql += ' where '
+        if isinstance(conditions, str):
+            sql += conditions
+        elif isinstance(conditions, dict):
+            if not conditions:
+                raise ValueError('Conditions was an empty dict')
+            sql += ' and '.join(['%s=%s'] * len(conditions))
+            for key in conditions:
+                args.append(SchemaName(key))
+                args.append(conditions[key])
+        elif isinstance(conditions, tuple) or isinstance(conditions, list):
+            sql += conditions[0]
+            args += conditions[1:]
+        else:
+            raise ValueError("Don't know what to do with these conditions")
+    return sql, args
+
+# array typecodes for columns of numeric postgres types, by type oid
+_COLUMN_TYPECODES = {
+    21: 'h', # int2
+    23: 'i', # int4
+    26: 'I', # oid
+    700: 'f', # float4
+    701: 'd', # float8
+}
+try:
+    array.array('q')
+    _COLUMN_TYPECODES[20] = 'q' # int8
+except ValueError:
+    # python 2 has no long long arrays, long is 64 bits on most platforms
+    if array.array('l').itemsize == 8:
+        _COLUMN_TYPECODES[20] = 'l'
+
+def _append_columns(columns, rows):
+    for index, values in enumerate(zip(*rows)):
+        column = columns[index]
+        if isinstance(column, array.array) and None in values:
+            # arrays cannot hold nulls
+            column = columns[index] = column.tolist()
+        column.extend(values)
+
+def _numpy_column(column):
+    if isinstance(column, array.array):
+        return numpy.frombuffer(column, dtype=column.typecode)
+    return numpy.array(column, dtype=object)
+
+# Keyset pagination. Key columns are given as names optionally followed
+# by asc or desc, e.g. ['created_at desc', 'id desc'], and must identify
+# rows uniquely and be not null.
+
+def _key_column(spec):
+    parts = spec.split()
+    if len(parts) == 2 and parts[1].lower() in ('asc', 'desc'):
+        return parts[0], parts[1].lower() == 'desc'
+    if len(parts) != 1:
+        raise ValueError('Bad key column: %s' % spec)
+    return spec, False
+
+def _paginate_query(sql, key_columns, page_size, after, args):
+    keys = [_key_column(spec) for spec in key_columns]
+    if isinstance(args, dict):
+        raise ValueError('Pagination requires positional arguments')
+    args = list(args)
+    sql = 'select * from (%s) as olib_page' % sql
+    if after is not None:
+        if len(after) != len(keys):
+            raise ValueError('Pagination token does not match key columns')
+        directions = set([descending for name, descending in keys])
+        if len(directions) == 1:
+            # row comparison can use a multicolumn index
+            placeholders = ', '.join(['%s'] * len(keys))
+            sql += ' where (%s) %s (%s)' % (
+                ', '.join(['olib_page.%s'] * len(keys)),
+                directions.pop() and '<' or '>', placeholders)
+            args += [SchemaName(name) for name, descending in keys]
+            args += list(after)
+        else:
+            conditions = []
+            for index, (name, descending) in enumerate(keys):
+                condition = ['olib_page.%s = %s'] * index
+                condition.append('olib_page.%%s %s %%s' % (descending and '<' or '>'))
+                conditions.append('(%s)' % ' and '.join(condition))
+                for previous, value in zip(keys[:index], after):
+                    args += [SchemaName(previous[0]), value]
+                args += [SchemaName(name), after[index]]
+            sql += ' where ' + ' or '.join(conditions)
+    sql += ' order by ' + ', '.join([descending and 'olib_page.%s desc' or 'olib_page.%s'
+        for name, descending in keys])
+    args += [SchemaName(name) for name, descending in keys]
+    sql += ' limit %s'
+    args.append(page_size)
+    return sql, args
+
+# values without a json representation are passed back as strings,
+# which postgres coerces to the type of the key column
+def _token_value(value):
+    if isinstance(value, (datetime.date, datetime.time, datetime.timedelta, decimal.Decimal)):
+        return str(value)
+    return unicode(value)
+
+def _encode_page_token(values):
+    data = json.dumps(values, default=_token_value, separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii')
+
+def _decode_page_token(token):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(str(token)).decode('utf-8'))
+    except (TypeError, ValueError):
+        raise ValueError('Invalid pagination token')
+    if not isinstance(values, list):
+        raise ValueError('Invalid pagination token')
+    return values
+
+# serialization_failure and deadlock_detected
+RETRYABLE_SQLSTATES = frozenset(['40001', '40P01'])
+
+# a prepared statement whose result type changed with the schema,
+# it is not prepared again when the transaction is retried
+def _plan_changed(error):
+    return getattr(error, 'pgcode', None) == '0A000' and \
+        'cached plan must not change result type' in str(error)
+
+# returns error, or on python 3 the exception it was raised while
+# handling, if it warrants retrying the transaction
+def _retryable_error(error):
+    seen = set()
+    while error is not None and id(error) not in seen:
+        if isinstance(error, DatabaseConnectionClosed) or \
+            getattr(error, 'pgcode', None) in RETRYABLE_SQLSTATES or \
+            _plan_changed(error) \
+        :
+            return error
+        seen.add(id(error))
+        error = getattr(error, '__cause__', None) or getattr(error, '__context__', None)
+    return None
+
+# statements that read_cursor stickiness does not consider writes
+_READ_REGEXP = re.compile(r'^\s*(select|show|explain|values)\b', re.I)
+
+_CACHEABLE_REGEXP = re.compile(r'^\s*select\b', re.I)
+
+# tables passed to the write helpers are quoted with SchemaName, so
+# unlike unquoted names in queries they are not folded to lower case
+def _quoted_table(table):
+    return '"%s"' % table
+
 class CachingCursorWrapper(object):
-    def __init__(self, cursor):
+    '''Serves repeated select queries from a dbcache.QueryCache.
+    
+    Other statements are passed through to the wrapped cursor. If conn,
+    the ConnectionWrapper of the cursor, is given, queries in a
+    transaction that has written are not served from the cache and
+    their results are stored only once the transaction commits, so that
+    the cache never holds uncommitted data. Results reading tables the
+    transaction wrote through CursorWrapper helpers are dropped then, as
+    the tables are invalidated again at commit.
+    '''
+    
+    def __init__(self, cursor, cache=None, conn=None):
         self.cursor = cursor
-        self.cache = {}
+        if cache is None:
+            cache = dbcache.QueryCache()
+        self.cache = cache
+        self.conn = conn
+        self.result = None
+        self.executing = False
+        # whether result was served from the cache
+        self.hit = False
+        # rows of result returned by fetchmany
+        self.fetched = 0
     
     def mogrify(self, sql, args):
         return self.cursor.mogrify(sql, args)
     
     def execute(self, sql, args):
-        key = (sql, repr(args))
-        if key in self.cache:
-            self.result = self.cache[key]
-            self.executing = False
+        self.fetched = 0
+        # scripts (args is None) may hold several statements
+        if args is not None and _CACHEABLE_REGEXP.match(sql):
+            key = dbcache.cache_key(sql, args)
+            # cached results do not reflect the transaction's own writes
+            if not self._wrote():
+                self.result = self.cache.get(key)
+                if self.result is not None:
+                    self.executing = False
+                    self.hit = True
+                    return
+        else:
+            key = None
+        generation = self.cache.generation()
+        # statements are prepared here rather than by CursorWrapper so
+        # that results are cached under the statement, not under execute
+        if self.conn is not None:
+            self.conn._execute_prepared(self.cursor, sql, args)
         else:
             self.cursor.execute(sql, args)
-            self.result = self.cache[key] = {}
-            self.executing = True
+        self._pending = (key, sql, generation)
+        self.executing = True
+        self.hit = False
     
     def populate_result(self):
-        rows = self.cursor.fetchall()
+        key, sql, generation = self._pending
         description = self.cursor.description
-        self.result['rows'] = rows
-        self.result['description'] = description
+        if description is None:
+            rows = []
+        else:
+            rows = self.cursor.fetchall()
+        self.result = dbcache.CachedResult(rows, description, (), 0, None)
+        if key is not None and description is not None:
+            put = (key, rows, description, dbcache.tables_in_sql(sql), generation)
+            if self._wrote():
+                self.conn._state.cache_puts.append((self.cache, put))
+            else:
+                self.cache.put(*put)
         self.executing = False
     
+    def _wrote(self):
+        return self.conn is not None and self.conn._state.cache_puts is not None
+    
+    def invalidate_table(self, table):
+        self.cache.invalidate_table(table)
+    
     @property
     def description(self):
         if self.executing:
             self.populate_result()
-        return self.result['description']
+        return self.result.description
     
     def fetchall(self):
         if self.executing:
             self.populate_result()
-        return self.result['rows']
+        return self.result.rows
     
     def fetchone(self):
         if self.executing:
             self.populate_result()
-        rows = self.result['rows']
+        rows = self.result.rows
         if rows:
             return rows[0]
         else:
             return None
     
+    def fetchmany(self, size):
+        if self.executing:
+            self.populate_result()
+        rows = self.result.rows[self.fetched:self.fetched + size]
+        self.fetched += len(rows)
+        return rows
+    
+    @property
+    def rowcount(self):
+        if self.hit:
+            return len(self.result.rows)
+        return self.cursor.rowcount
+    
     def close(self):
         self.cursor.close()
 
+_PREPARABLE_REGEXP = re.compile(r'^\s*(select|insert|update|delete|with|values)\b', re.I)
+_PLACEHOLDER_REGEXP = re.compile(r'%(.)', re.S)
+
+# select * from table where column = ?, as loaded by identity maps
+_IDENTITY_REGEXP = re.compile(r'^\s*select\s+\*\s+from\s+("[^"]+"|\w+)\s+where\s+("[^"]+"|\w+)\s*=\s*%s\s*$', re.I)
+
+def _exact_key(value):
+    # bool is a subclass of int but compares equal to 0 and 1
+    return isinstance(value, (int, long)) and not isinstance(value, bool)
+
+# returns the identity map key for a query and its arguments or None
+def _identity_key(sql, args):
+    identity = _sql_cache.lookup(sql).identity()
+    if not identity or not isinstance(args, (list, tuple)) or len(args) != 1:
+        return None
+    key = args[0]
+    try:
+        hash(key)
+    except TypeError:
+        return None
+    return identity + (key,)
+
+class _TranslatedSql(object):
+    '''Forms of one sql string as passed to CursorWrapper methods.'''
+    
+    __slots__ = ['sql', '_munged', '_normalized', '_identity']
+    
+    def __init__(self, sql):
+        self.sql = sql.replace('?', '%s')
+        self._munged = None
+        self._normalized = None
+        self._identity = None
+    
+    def munged(self):
+        '''Returns (munged sql, munge mapping).'''
+        
+        if self._munged is None:
+            self._munged = _munge_sql(self.sql)
+        return self._munged
+    
+    def normalized(self):
+        if self._normalized is None:
+            self._normalized = _normalize_sql(self.sql)
+        return self._normalized
+    
+    def identity(self):
+        '''Returns (table, column) if this is a single row lookup by a
+        column, otherwise an empty tuple.'''
+        
+        if self._identity is None:
+            match = _IDENTITY_REGEXP.match(self.sql)
+            if match is None:
+                self._identity = ()
+            else:
+                self._identity = (dbcache.table_key(match.group(1)),
+                    dbcache.table_key(match.group(2)))
+        return self._identity
+
+class SqlCache(object):
+    '''Memo of translated sql keyed on the sql text given by the caller.
+    
+    Like the pattern cache in the re module it is emptied when it grows
+    past maxsize, which keeps a hit down to a single dict lookup. Counters
+    are not synchronized between threads and are approximate.
+    '''
+    
+    def __init__(self, maxsize=1000):
+        self.maxsize = maxsize
+        self._entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.clears = 0
+    
+    def lookup(self, sql):
+        entry = self._entries.get(sql)
+        if entry is not None:
+            self.hits += 1
+            return entry
+        self.misses += 1
+        if len(self._entries) >= self.maxsize:
+            self._entries = {}
+            self.clears += 1
+        entry = self._entries[sql] = _TranslatedSql(sql)
+        return entry
+    
+    def clear(self):
+        self._entries = {}
+    
+    def stats(self):
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'clears': self.clears,
+        }
+
+_sql_cache = SqlCache()
+
+def sql_cache_stats():
+    return _sql_cache.stats()
+
+# only positional statements of kinds accepted by PREPARE are prepared;
+# arguments that are spliced into the sql text (names, expressions,
+# tuples expanded for IN) cannot become statement parameters
+def _preparable(sql, args):
+    if not isinstance(args, (list, tuple)):
+        return False
+    if ';' in sql or not _PREPARABLE_REGEXP.match(sql):
+        return False
+    for arg in args:
+        if isinstance(arg, (ExpressionValue, SchemaName, tuple, list, dict)):
+            return False
+    return True
+
+def _normalize_sql(sql):
+    sql = sql.strip()
+    # whitespace inside literals and quoted names is significant
+    if "'" in sql or '"' in sql or '$' in sql:
+        return sql
+    return ' '.join(sql.split())
+
+def _numbered_placeholders(sql):
+    '''Converts %s placeholders to $1, $2, ... as used by PREPARE.
+    Returns None if sql contains other placeholders.'''
+    
+    numbers = itertools.count(1)
+    invalid = []
+    def replace(match):
+        if match.group(1) == 's':
+            return '$%d' % next(numbers)
+        if match.group(1) == '%':
+            return '%'
+        invalid.append(match.group(0))
+        return match.group(0)
+    
+    sql = _PLACEHOLDER_REGEXP.sub(replace, sql)
+    if invalid:
+        return None
+    return sql
+
+# prepared statement names must be unique within a connection
+_statement_numbers = itertools.count()
+
+class _PreparedStatementCache(object):
+    '''Prepared statements of one connection, keyed by normalized sql.
+    
+    A statement is prepared once it has been seen threshold times. At
+    most size statements are kept, the least recently used statement
+    is deallocated to make room for a new one. Statements invalidated
+    by a schema change are deallocated by the next lookup made outside
+    of an aborted transaction.
+    '''
+    
+    def __init__(self, size, threshold, stats):
+        self.size = size
+        self.threshold = threshold
+        self.stats = stats
+        # key -> statement name
+        self.statements = collections.OrderedDict()
+        # key -> times seen before being prepared, None if unpreparable
+        self.counts = collections.OrderedDict()
+        # names of invalidated statements not yet deallocated
+        self.stale = []
+    
+    def lookup(self, conn, key, sql):
+        if self.stale and conn.get_transaction_status() != \
+            psycopg2.extensions.TRANSACTION_STATUS_INERROR \
+        :
+            stale = self.stale
+            self.stale = []
+            for name in stale:
+                self._deallocate(conn, name)
+        
+        name = self.statements.pop(key, None)
+        if name is not None:
+            self.statements[key] = name
+            self.stats['hits'] += 1
+            return name
+        
+        self.stats['misses'] += 1
+        count = self.counts.pop(key, 0)
+        if count is None:
+            self.counts[key] = None
+            return None
+        count += 1
+        if count < self.threshold:
+            self.counts[key] = count
+            if len(self.counts) > self.size * 10:
+                self.counts.popitem(last=False)
+            return None
+        
+        name = self._prepare(conn, sql)
+        if name is None:
+            self.counts[key] = None
+            return None
+        self.statements[key] = name
+        if len(self.statements) > self.size:
+            key, evicted = self.statements.popitem(last=False)
+            self._deallocate(conn, evicted)
+            self.stats['evictions'] += 1
+        return name
+    
+    def invalidate(self, key):
+        '''Drops the statement for key, which is prepared again once it
+        has been seen threshold more times.'''
+        
+        name = self.statements.pop(key, None)
+        if name is not None:
+            self.stale.append(name)
+            self.stats['invalidations'] += 1
+        self.counts.pop(key, None)
+    
+    def _deallocate(self, conn, name):
+        cursor = conn.cursor()
+        try:
+            cursor.execute('deallocate %s' % name)
+        finally:
+            cursor.close()
+    
+    def _prepare(self, conn, sql):
+        sql = _numbered_placeholders(sql)
+        if sql is None:
+            return None
+        name = 'olib_ps_%d' % next(_statement_numbers)
+        cursor = conn.cursor()
+        try:
+            # statements whose parameter types cannot be inferred fail to
+            # prepare; the savepoint keeps the transaction usable then
+            try:
+                cursor.execute('savepoint olib_prepare; prepare %s as %s; release savepoint olib_prepare' % (name, sql))
+            except psycopg2.OperationalError:
+                raise
+            except psycopg2.Error:
+                cursor.execute('rollback to savepoint olib_prepare; release savepoint olib_prepare')
+                self.stats['failures'] += 1
+                return None
+        finally:
+            cursor.close()
+        self.stats['prepared'] += 1
+        return name
+
 class CursorWrapper(object):
     def __init__(self, cursor, conn,
         debug_queries=False, debug_transactions=False,
@@ -119,54 +748,90 @@ class CursorWrapper(object):
         self.conn = conn
         self._debug_queries = debug_queries
         self._debug_transactions = debug_transactions
+        self._closed = False
+    
+    # dbstats.QueryObserver instances notified of statements executed on
+    # this cursor in addition to the observers of its connection
+    observers = ()
+    
+    # set by tx_cursor(identity_map=True)
+    use_identity_map = False
+    
+    # maps (table, column, value) to rows loaded by one/one_check with
+    # select * from table where column = ?, or by one_by_key, if enabled
+    # with tx_cursor(identity_map=True). The map belongs to the connection's
+    # transaction (per thread with a pool), and writes made through
+    # insert_dict, insert_many, update and update_many on any of its
+    # cursors evict rows; other writes do not. Rows are dropped when the
+    # transaction ends and when a nested transaction rolls back.
+    @property
+    def identity_map(self):
+        if self.use_identity_map:
+            return self.conn._state.identity_map
+        return None
+    
+    def add_observer(self, observer):
+        self.observers = tuple(self.observers) + (observer,)
     
     def execute(self, sql, *args):
         return self.execute2(sql, args)
     
     def execute2(self, sql, args, munge=False):
-        sql = sql.replace('?', '%s')
-        
-        convert_lists = False
-        
-        if args is None:
-            args = ()
-        elif isinstance(args, dict):
-            # keep as a dict
-            # convert lists to tuples
-            for key in args:
-                value = args[key]
-                if isinstance(value, list):
-                    args[key] = tuple(value)
-        elif isinstance(args, basestring) or getattr(args, '__len__', None) is None:
-            args = (args,)
-            convert_lists = True
-        else:
-            # a tuple or a list
-            convert_lists = True
-        
-        if convert_lists:
-            args = map(_lists_to_tuples, args)
+        sql, args, self._munge_mapping = _prepare_query(sql, args, munge)
+        self._execute(sql, args)
+    
+    # executes sql, which has already gone through _prepare_query or
+    # is to be sent verbatim if args is None, notifying observers.
+    # If given, run is called to execute sql instead of _execute_query
+    # and returns the row count.
+    def _execute(self, sql, args, run=None):
+        if not _READ_REGEXP.match(sql):
+            self.conn._wrote()
         
-        if munge:
-            sql, self._munge_mapping = _munge_sql(sql)
-        else:
-            self._munge_mapping = None
+        observers = self.conn.observers
+        if self.observers:
+            observers = observers + self.observers
+        if not observers:
+            if run is None:
+                self._execute_query(sql, args)
+            else:
+                run()
+            return
         
+        start = time.time()
+        try:
+            if run is None:
+                self._execute_query(sql, args)
+                rowcount = None
+            else:
+                rowcount = run()
+        except Exception as e:
+            duration = time.time() - start
+            for observer in observers:
+                observer.on_query(self, sql, args, duration, None, e)
+            raise
+        duration = time.time() - start
+        if run is None:
+            rowcount = getattr(self.cursor, 'rowcount', -1)
+        for observer in observers:
+            observer.on_query(self, sql, args, duration, rowcount, None)
+    
+    def _execute_query(self, sql, args):
         try:
             if self._debug_queries:
-                debug_sql = self.cursor.mogrify(sql, args)
-                #debug_sql = sql.strip()
-                #if args:
-                    #debug_sql += ', ' + repr(args)
-                debug_sql = WHITESPACE_REGEXP.sub('     ', debug_sql.strip())
-                print 'SQL:', debug_sql
-            self.cursor.execute(sql, args)
-        except psycopg2.OperationalError, e:
+                self._debug_query(self.cursor, sql, args)
+            if isinstance(self.cursor, CachingCursorWrapper):
+                # it prepares statements it does not serve from its cache
+                self.cursor.execute(sql, args)
+            else:
+                self.conn._execute_prepared(self.cursor, sql, args)
+        except psycopg2.OperationalError as e:
             if str(e).startswith('server closed the connection unexpectedly'):
                 if self.conn._transaction_depth == 0:
                     self.conn.reconnect()
-                    self.cursor = self.conn.cursor()
-                    self.cursor.execute(sql, args)
+                    self.cursor = self.conn.conn.cursor()
+                    exec_sql, exec_args = self.conn._prepared_statement(sql, args)
+                    self.cursor.execute(exec_sql, exec_args)
                 else:
                     self.conn.want_reconnect = True
                     raise DatabaseConnectionClosed
@@ -177,11 +842,53 @@ class CursorWrapper(object):
             #self.conn._transaction_depth += 1
             #self.conn._transaction_depth_request -= 1
     
-    def execute_many(self, sql_commands):
-        for sql in sql_commands.split(';'):
-            sql = sql.strip()
-            if sql:
-                self.execute2(sql, ())
+    def _debug_query(self, cursor, sql, args):
+        debug_sql = cursor.mogrify(sql, args)
+        #debug_sql = sql.strip()
+        #if args:
+            #debug_sql += ', ' + repr(args)
+        debug_sql = WHITESPACE_REGEXP.sub('     ', debug_sql.strip())
+        print('SQL:', debug_sql)
+    
+    def execute_batch(self, sql, arg_list, page_size=100):
+        '''Executes sql once for each set of arguments in arg_list,
+        sending up to page_size statements per round trip.'''
+        
+        page = []
+        for args in arg_list:
+            statement, args, munge_mapping = _prepare_query(sql, args, False)
+            page.append(self.cursor.mogrify(statement, args))
+            if len(page) >= page_size:
+                self._execute_statements(page)
+                page = []
+        if page:
+            self._execute_statements(page)
+    
+    # executes already interpolated statements in one round trip
+    def _execute_statements(self, statements):
+        sql = b';'.join(statements)
+        if not isinstance(sql, str):
+            # python 3 mogrify returns bytes
+            sql = sql.decode(psycopg2.extensions.encodings[self.conn.conn.encoding])
+        self._munge_mapping = None
+        self._execute(sql, None)
+    
+    # execute_many sends a script of statements without parameters
+    # verbatim, so ? and % need no escaping. The script is sent in one
+    # round trip unless attribute_errors is true, in which case statements
+    # are sent one at a time and a failure raises StatementError.
+    
+    def execute_many(self, sql_commands, attribute_errors=False):
+        self._munge_mapping = None
+        if not attribute_errors:
+            if sql_commands.strip():
+                self._execute(sql_commands, None)
+            return
+        for index, sql in enumerate(split_sql_statements(sql_commands)):
+            try:
+                self._execute(sql, None)
+            except psycopg2.Error as e:
+                raise StatementError(index, sql, e)
     
     #def fetchall(self):
         #return self.cursor.fetchall()
@@ -198,16 +905,63 @@ class CursorWrapper(object):
         return self.one2(sql, args, munge=True)
     
     def one2(self, sql, args, **kwargs):
+        identity = None
+        if self.identity_map is not None and not kwargs.get('munge'):
+            identity = _identity_key(sql, args)
+            if identity is not None:
+                row = self.identity_map.get(identity)
+                if row is not None:
+                    return row
         self.execute2(sql, args, **kwargs)
         row = self.cursor.fetchone()
         if row is None:
             return None
-        desc = dtuple.TupleDescriptor(self.cursor.description)
-        row = dtuple.DatabaseTuple(desc, row)
         if self._munge_mapping:
-            row = _munge_row(dict(row), self._munge_mapping)
+            return _munge_plan(self._names(), self._munge_mapping).apply(row)
+        row = dbrow.description_row_class(self.cursor.description)(row)
+        if identity is not None:
+            self.identity_map[identity] = row
         return row
     
+    def one_by_key(self, table, key, column='id'):
+        '''Returns the row of table with the given value of column, or
+        None, using the identity map if enabled.'''
+        
+        # table and column are quoted with SchemaName, so their names
+        # are exact like those of quoted names in _IDENTITY_REGEXP matches
+        identity = (table, column, key)
+        if self.identity_map is not None:
+            row = self.identity_map.get(identity)
+            if row is not None:
+                return row
+        row = self.one('select * from %s where %s = %s',
+            SchemaName(table), SchemaName(column), key)
+        if row is not None and self.identity_map is not None:
+            self.identity_map[identity] = row
+        return row
+    
+    # evicts rows of table with the given ids from the identity map,
+    # all rows of table if ids is None. Rows loaded by other columns
+    # are always evicted, their keys are unknown. Keys are compared as
+    # the database would only if they and the ids are integers; the
+    # server converts '5' and '05' to 5, so other keys not equal to an
+    # id are evicted as well.
+    def _forget_rows(self, table, ids=None):
+        identity_map = self.conn._state.identity_map
+        if not identity_map:
+            return
+        if ids is None:
+            identities = [identity for identity in identity_map
+                if identity[0] == table]
+        else:
+            ids = list(ids)
+            exact = all([_exact_key(id) for id in ids])
+            identities = [identity for identity in identity_map
+                if identity[0] == table and (identity[1] != 'id' or
+                    identity[2] in ids or not (exact and _exact_key(identity[2])))]
+        for identity in identities:
+            del identity_map[identity]
+    
     def one_check(self, sql, *args):
         return self.one_check2(sql, args)
     
@@ -217,7 +971,7 @@ class CursorWrapper(object):
     def one_check2(self, sql, args, **kwargs):
         row = self.one2(sql, args, **kwargs)
         if row is None:
-            raise NotFoundError, "No data %s" % repr(args)
+            raise NotFoundError("No data %s" % repr(args))
         return row
     
     def all(self, sql, *args):
@@ -230,13 +984,127 @@ class CursorWrapper(object):
         self.execute2(sql, args, **kwargs)
         if self.cursor.description is None:
             raise MissingCursorDescriptionError
-        desc = dtuple.TupleDescriptor(self.cursor.description)
         rows = self.cursor.fetchall()
-        rows = [dtuple.DatabaseTuple(desc, row) for row in rows]
         if self._munge_mapping:
-            # XXX dispose of dict() call
-            rows = [_munge_row(dict(row), self._munge_mapping) for row in rows]
-        return rows
+            apply = _munge_plan(self._names(), self._munge_mapping).apply
+            return [apply(row) for row in rows]
+        row_class = dbrow.description_row_class(self.cursor.description)
+        return [row_class(row) for row in rows]
+    
+    def _names(self):
+        return [column[0] for column in self.cursor.description]
+    
+    # Columnar interface
+    
+    def all_columns(self, sql, *args):
+        return self.all_columns2(sql, args)
+    
+    def all_columns2(self, sql, args, batch_size=10000):
+        '''Returns the result of a query as an ordered mapping of column
+        names to sequences of column values.
+        
+        Columns of integer and floating point types without nulls are
+        returned as array.array, other columns as lists. If numpy is
+        installed all columns are returned as numpy arrays, of object
+        dtype for non-numeric columns and columns with nulls.
+        '''
+        
+        self.execute2(sql, args)
+        description = self.cursor.description
+        if description is None:
+            raise MissingCursorDescriptionError
+        columns = []
+        for column in description:
+            typecode = _COLUMN_TYPECODES.get(column[1])
+            if typecode is None:
+                columns.append([])
+            else:
+                columns.append(array.array(typecode))
+        while True:
+            rows = self.cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            _append_columns(columns, rows)
+        if numpy is not None:
+            columns = [_numpy_column(column) for column in columns]
+        return collections.OrderedDict(
+            [(column[0], values) for column, values in zip(description, columns)])
+    
+    # Streaming interface
+    
+    # iter_all/etc. read rows through a server-side (named) cursor,
+    # fetching batch_size rows per round trip. Named cursors only exist
+    # within a transaction, the rows must be consumed before it ends.
+    
+    def iter_all(self, sql, *args, **kwargs):
+        return self.iter_all2(sql, args, **kwargs)
+    
+    def iter_allm(self, sql, *args, **kwargs):
+        return self.iter_all2(sql, args, munge=True, **kwargs)
+    
+    def iter_all2(self, sql, args, munge=False, batch_size=1000):
+        sql, args, munge_mapping = _prepare_query(sql, args, munge)
+        cursor = self.conn.conn.cursor('olib_cursor_%d' % next(_cursor_numbers))
+        try:
+            if self._debug_queries:
+                self._debug_query(cursor, sql, args)
+            
+            def run():
+                cursor.execute(sql, args)
+                return cursor.rowcount
+            # marks writes for read_cursor and notifies observers
+            self._execute(sql, args, run)
+            rows = cursor.fetchmany(batch_size)
+            if cursor.description is None:
+                raise MissingCursorDescriptionError
+            if munge_mapping:
+                make_row = _munge_plan([column[0] for column in cursor.description],
+                    munge_mapping).apply
+            else:
+                make_row = dbrow.description_row_class(cursor.description)
+            while rows:
+                for row in rows:
+                    yield make_row(row)
+                rows = cursor.fetchmany(batch_size)
+        finally:
+            try:
+                cursor.close()
+            except psycopg2.Error:
+                # the transaction was aborted or has already ended
+                pass
+    
+    # Keyset pagination
+    
+    def paginate(self, sql, key_columns, page_size, after=None, args=()):
+        '''Returns a page of up to page_size rows of the result of sql
+        ordered by key_columns, and a token to pass as after to get the
+        next page, which is None after the last page.
+        
+        Pages are selected by key values rather than offsets, so every
+        page costs the same given an index on the key columns.
+        '''
+        
+        if after is not None:
+            after = _decode_page_token(after)
+        page_sql, page_args = _paginate_query(sql, key_columns, page_size, after, args)
+        rows = self.all2(page_sql, page_args)
+        if len(rows) < page_size:
+            return rows, None
+        last = rows[-1]
+        token = _encode_page_token([last[_key_column(spec)[0]] for spec in key_columns])
+        return rows, token
+    
+    def iter_pages(self, sql, key_columns, page_size=1000, args=()):
+        '''Yields the result of sql ordered by key_columns as lists of
+        up to page_size rows, each fetched with a separate query.'''
+        
+        token = None
+        while True:
+            rows, token = self.paginate(sql, key_columns, page_size, token, args)
+            if rows:
+                yield rows
+            if token is None:
+                break
     
     def one_value(self, sql, *args):
         return self.one_value2(sql, args)
@@ -255,7 +1123,7 @@ class CursorWrapper(object):
         self.execute2(sql, args)
         row = self.cursor.fetchone()
         if row is None:
-            raise NotFoundError, "No data %s" % repr(args)
+            raise NotFoundError("No data %s" % repr(args))
         return row[0]
     
     def all_values(self, sql, *args):
@@ -263,7 +1131,6 @@ class CursorWrapper(object):
     
     def all_values2(self, sql, args):
         self.execute2(sql, args)
-        desc = dtuple.TupleDescriptor(self.cursor.description)
         rows = self.cursor.fetchall()
         rows = [row[0] for row in rows]
         return rows
@@ -285,7 +1152,13 @@ class CursorWrapper(object):
         self.begin()
     
     def close(self):
-        return self.cursor.close()
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            return self.cursor.close()
+        finally:
+            self.conn._release_cursor()
     
     # Statements
     
@@ -311,47 +1184,176 @@ class CursorWrapper(object):
         return self._insert_dict_impl(table, dict, True)
     
     def _insert_dict_impl(self, table, dict, return_id):
-        if not dict:
-            raise ValueError, 'Cannot insert an empty dict'
-        placeholders = ', '.join(['%s'] * len(dict))
-        sql = 'insert into %%s (%s) values (%s)' % (placeholders, placeholders)
-        if return_id:
-            sql += ' returning (id)'
-        table = SchemaName(table)
-        columns = [SchemaName(column) for column in dict.keys()]
-        values = dict.values()
-        args = [table] + columns + values
-        self.execute(sql, *args)
+        sql, args = _insert_dict_query(table, dict, return_id)
+        self.execute2(sql, args)
+        self.conn.invalidate_table(_quoted_table(table))
+        if 'id' in dict:
+            self._forget_rows(table, [dict['id']])
         if return_id:
             row = self.cursor.fetchone()
             return row[0]
     
-    def update(self, table, attrs, conditions):
-        if not attrs:
-            raise ValueError, 'Trying to update with an empty attrs'
-        placeholders = ', '.join(['%s=%s'] * len(attrs))
-        sql = 'update %s set ' + placeholders
-        args = [SchemaName(table)]
-        for key in attrs:
-            args.append(SchemaName(key))
-            args.append(attrs[key])
-        if conditions is not None:
-            sql += ' where '
-            if isinstance(conditions, str):
-                sql += conditions
-            elif isinstance(conditions, dict):
-                if not conditions:
-                    raise ValueError, 'Conditions was an empty dict'
-                sql += ' and '.join(['%s=%s'] * len(conditions))
-                for key in conditions:
-                    args.append(SchemaName(key))
-                    args.append(conditions[key])
-            elif isinstance(conditions, tuple) or isinstance(conditions, list):
-                sql += conditions[0]
-                args += conditions[1:]
+    # insert_many/insert_many_ids take a sequence of dicts. Rows are grouped
+    # by their column sets and each group is inserted with multi-row
+    # INSERTs of up to page_size rows. insert_many loads groups of at least
+    # copy_threshold rows with COPY FROM STDIN instead, as long as all of
+    # their values can be represented in COPY text format.
+    
+    def insert_many(self, table, rows, page_size=500, copy_threshold=1000):
+        rows = list(rows)
+        self._forget_rows(table, [row['id'] for row in rows if 'id' in row])
+        for columns, indexes in _group_rows(rows):
+            group = [rows[index] for index in indexes]
+            if len(group) >= copy_threshold and _copyable(group, columns):
+                self._copy_rows(table, columns, group)
             else:
-                raise ValueError, "Don't know what to do with these conditions"
-        self.execute(sql, *args)
+                self._insert_rows(table, columns, group, False, page_size)
+    
+    def insert_many_ids(self, table, rows, page_size=500):
+        '''Returns ids of inserted rows in the order of rows.'''
+        
+        rows = list(rows)
+        self._forget_rows(table, [row['id'] for row in rows if 'id' in row])
+        ids = [None] * len(rows)
+        for columns, indexes in _group_rows(rows):
+            group = [rows[index] for index in indexes]
+            group_ids = self._insert_rows(table, columns, group, True, page_size)
+            for index, id in zip(indexes, group_ids):
+                ids[index] = id
+        return ids
+    
+    def _insert_rows(self, table, columns, rows, return_id, page_size):
+        names = [SchemaName(table)] + [SchemaName(column) for column in columns]
+        sql_prefix = 'insert into %%s (%s) values ' % ', '.join(['%s'] * len(columns))
+        row_placeholders = '(%s)' % ', '.join(['%s'] * len(columns))
+        ids = []
+        for start in range(0, len(rows), page_size):
+            page = rows[start:start + page_size]
+            sql = sql_prefix + ', '.join([row_placeholders] * len(page))
+            if return_id:
+                sql += ' returning (id)'
+            args = list(names)
+            for row in page:
+                args.extend([row[column] for column in columns])
+            self.execute2(sql, args)
+            if return_id:
+                ids.extend([row[0] for row in self.cursor.fetchall()])
+        self.conn.invalidate_table(_quoted_table(table))
+        return ids
+    
+    def _copy_rows(self, table, columns, rows):
+        conn = self.conn.conn
+        encoding = psycopg2.extensions.encodings[conn.encoding]
+        lines = []
+        for row in rows:
+            values = [_copy_text(row[column], encoding) for column in columns]
+            lines.append(u'\t'.join(values))
+        lines.append(u'')
+        data = io.BytesIO(u'\n'.join(lines).encode(encoding))
+        
+        cursor = conn.cursor()
+        try:
+            sql = cursor.mogrify('copy %%s (%s) from stdin' % ', '.join(['%s'] * len(columns)),
+                [SchemaName(table)] + [SchemaName(column) for column in columns])
+            if not isinstance(sql, str):
+                # python 3 mogrify returns bytes
+                sql = sql.decode(encoding)
+            if self._debug_queries:
+                self._debug_query(cursor, sql, None)
+            
+            def run():
+                cursor.copy_expert(sql, data)
+                return cursor.rowcount
+            # marks the write for read_cursor and notifies observers
+            self._execute(sql, None, run)
+        finally:
+            cursor.close()
+        self.conn.invalidate_table(_quoted_table(table))
+    
+    def update(self, table, attrs, conditions):
+        sql, args = _update_query(table, attrs, conditions)
+        self.execute2(sql, args)
+        self.conn.invalidate_table(_quoted_table(table))
+        if isinstance(conditions, dict) and list(conditions) == ['id']:
+            self._forget_rows(table, [conditions['id']])
+        else:
+            self._forget_rows(table)
+    
+    # update_many takes a sequence of dicts, each holding key_columns
+    # identifying the row to update and the new values of other columns.
+    # Rows are grouped by their column sets and each group is updated with
+    # one UPDATE ... FROM (VALUES ...) statement per page_size rows.
+    
+    def update_many(self, table, rows, key_columns, page_size=500):
+        '''Returns the number of updated rows.'''
+        
+        if isinstance(key_columns, basestring):
+            key_columns = [key_columns]
+        rows = list(rows)
+        types = None
+        count = 0
+        for columns, indexes in _group_rows(rows):
+            missing = [column for column in key_columns if column not in columns]
+            if missing:
+                raise ValueError('Rows to update lack key columns: %s' % ', '.join(missing))
+            value_columns = [column for column in columns if column not in key_columns]
+            if not value_columns:
+                continue
+            if types is None:
+                types = self._column_types(table)
+            missing = [column for column in columns if column not in types]
+            if missing:
+                raise ValueError('Table %s has no columns %s' % (table, ', '.join(missing)))
+            group = [rows[index] for index in indexes]
+            count += self._update_rows(table, list(key_columns), value_columns,
+                group, types, page_size)
+        self.conn.invalidate_table(_quoted_table(table))
+        if list(key_columns) == ['id']:
+            self._forget_rows(table, [row['id'] for row in rows])
+        else:
+            self._forget_rows(table)
+        return count
+    
+    def _column_types(self, table):
+        self.execute2('''
+            select attname, format_type(atttypid, atttypmod)
+            from pg_attribute
+            where attrelid = %s::regclass and attnum > 0 and not attisdropped
+        ''', ('"%s"' % table.replace('"', '""'),))
+        return dict(self.cursor.fetchall())
+    
+    def _update_rows(self, table, key_columns, value_columns, rows, types, page_size):
+        columns = key_columns + value_columns
+        assignments = ', '.join(['%s = olib_v.%s'] * len(value_columns))
+        conditions = ' and '.join(['olib_t.%s = olib_v.%s'] * len(key_columns))
+        sql_prefix = 'update %%s as olib_t set %s from (values ' % assignments
+        sql_suffix = ') as olib_v (%s) where %s' % (
+            ', '.join(['%s'] * len(columns)), conditions)
+        # values of the first row are cast to the column types, without
+        # the casts they would be text, which does not coerce on assignment
+        first_placeholders = '(%s)' % ', '.join(['%%s::%s' % types[column]
+            for column in columns])
+        row_placeholders = '(%s)' % ', '.join(['%s'] * len(columns))
+        names = []
+        for column in value_columns:
+            names += [SchemaName(column), SchemaName(column)]
+        column_names = [SchemaName(column) for column in columns]
+        key_names = []
+        for column in key_columns:
+            key_names += [SchemaName(column), SchemaName(column)]
+        count = 0
+        for start in range(0, len(rows), page_size):
+            page = rows[start:start + page_size]
+            sql = sql_prefix + ', '.join(
+                [first_placeholders] + [row_placeholders] * (len(page) - 1)
+            ) + sql_suffix
+            args = [SchemaName(table)] + names
+            for row in page:
+                args.extend([row[column] for column in columns])
+            args += column_names + key_names
+            self.execute2(sql, args)
+            count += self.cursor.rowcount
+        return count
     
     # DDL statements
     
@@ -416,41 +1418,471 @@ class TransactionalCursorContextManager(CursorContextManager):
         return CursorContextManager.__enter__(self)
     
     def __exit__(self, type, value, traceback):
-        if value is None:
-            self.cursor.commit()
-        else:
-            self.cursor.rollback()
-        return CursorContextManager.__exit__(self, type, value, traceback)
+        # the cursor must be closed even if commit/rollback fail,
+        # otherwise a pooled connection is never returned to the pool
+        try:
+            if value is None:
+                self.cursor.commit()
+            else:
+                self.cursor.rollback()
+        finally:
+            CursorContextManager.__exit__(self, type, value, traceback)
+
+class _ReplicaCursorContextManager(TransactionalCursorContextManager):
+    def __init__(self, cursor, primary, index):
+        TransactionalCursorContextManager.__init__(self, cursor)
+        self.primary = primary
+        self.index = index
+    
+    def __exit__(self, type, value, traceback):
+        failed = isinstance(value, (psycopg2.OperationalError,
+            psycopg2.InterfaceError, DatabaseConnectionClosed))
+        try:
+            TransactionalCursorContextManager.__exit__(self, type, value, traceback)
+        finally:
+            self.primary._replica_released(self.index, failed)
+
+class ConnectionPool(object):
+    '''Thread-safe pool of psycopg2 connections.
+    
+    connect is a callable returning a new connection. At most max_size
+    connections are open at any time; getconn blocks for up to timeout
+    seconds when all of them are checked out.
+    
+    Connections are checked for usability when they are checked out.
+    Connections idle for longer than max_idle seconds are closed as long
+    as more than min_size connections are open, and connections older
+    than max_lifetime seconds are closed regardless. Eviction happens
+    when connections are checked out or returned, the pool does not
+    run a background thread.
+    '''
+    
+    def __init__(self, connect, min_size=1, max_size=10, timeout=30,
+        max_idle=600, max_lifetime=3600, check=True,
+    ):
+        if max_size < 1:
+            raise ValueError('max_size must be at least 1')
+        if min_size > max_size:
+            raise ValueError('min_size cannot exceed max_size')
+        self._connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.max_lifetime = max_lifetime
+        self.check = check
+        self._lock = threading.Condition()
+        # (connection, time returned) pairs, most recently returned last
+        self._idle = []
+        # connection -> time opened, for all open connections
+        self._opened_at = {}
+        # includes connections that are being opened
+        self._size = 0
+        self._closed = False
+    
+    def fill(self):
+        '''Opens connections until there are at least min_size of them.'''
+        
+        while True:
+            with self._lock:
+                if self._closed or self._size >= self.min_size:
+                    return
+                self._size += 1
+            self.putconn(self._open())
+    
+    def getconn(self, timeout=None):
+        '''Checks out a connection, waiting up to timeout seconds
+        (the pool's timeout by default) for one to become available.'''
+        
+        if timeout is None:
+            timeout = self.timeout
+        deadline = time.time() + timeout
+        while True:
+            conn = None
+            with self._lock:
+                while True:
+                    if self._closed:
+                        raise PoolClosedError('Connection pool is closed')
+                    self._evict_idle()
+                    if self._idle:
+                        conn = self._idle.pop()[0]
+                        break
+                    if self._size < self.max_size:
+                        self._size += 1
+                        break
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise PoolTimeoutError('Timed out waiting for a connection after %s seconds' % timeout)
+                    self._lock.wait(remaining)
+            if conn is None:
+                return self._open()
+            if self._usable(conn):
+                return conn
+            self._discard(conn)
+    
+    def putconn(self, conn, close=False):
+        '''Returns a connection to the pool. A transaction left open on
+        the connection is rolled back.'''
+        
+        if not close and not conn.closed:
+            status = conn.get_transaction_status()
+            if status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    close = True
+        if close or conn.closed or self._expired(conn, time.time()):
+            self._discard(conn)
+            return
+        with self._lock:
+            if not self._closed:
+                self._idle.append((conn, time.time()))
+                self._lock.notify()
+                return
+        self._discard(conn)
+    
+    def closeall(self):
+        with self._lock:
+            self._closed = True
+            idle = self._idle
+            self._idle = []
+            self._lock.notify_all()
+        for conn, returned_at in idle:
+            self._discard(conn)
+    
+    def stats(self):
+        with self._lock:
+            return {
+                'size': self._size,
+                'idle': len(self._idle),
+                'in_use': self._size - len(self._idle),
+            }
+    
+    def _open(self):
+        # the caller has already reserved a slot for this connection
+        try:
+            conn = self._connect()
+        except:
+            with self._lock:
+                self._size -= 1
+                self._lock.notify()
+            raise
+        with self._lock:
+            self._opened_at[conn] = time.time()
+        return conn
+    
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+        with self._lock:
+            if self._opened_at.pop(conn, None) is not None:
+                self._size -= 1
+            self._lock.notify()
+    
+    def _expired(self, conn, now):
+        opened_at = self._opened_at.get(conn, now)
+        return self.max_lifetime is not None and now - opened_at > self.max_lifetime
+    
+    def _usable(self, conn):
+        if conn.closed or self._expired(conn, time.time()):
+            return False
+        if self.check:
+            try:
+                cursor = conn.cursor()
+                cursor.execute('select 1')
+                cursor.close()
+                conn.rollback()
+            except psycopg2.Error:
+                return False
+        return True
+    
+    # must be called with the lock held
+    def _evict_idle(self):
+        now = time.time()
+        keep = []
+        size = self._size
+        for conn, returned_at in self._idle:
+            idle_too_long = self.max_idle is not None and \
+                now - returned_at > self.max_idle and size > self.min_size
+            if idle_too_long or self._expired(conn, now):
+                try:
+                    conn.close()
+                except psycopg2.Error:
+                    pass
+                self._opened_at.pop(conn, None)
+                size -= 1
+            else:
+                keep.append((conn, returned_at))
+        if size != self._size:
+            self._size = size
+            self._idle = keep
+            self._lock.notify_all()
+
+class _ConnectionState(object):
+    '''Connection and transaction state of a ConnectionWrapper.
+    
+    Pooled connection wrappers keep one instance of this per thread.
+    '''
+    
+    def __init__(self):
+        self.conn = None
+        self.transaction_depth = 0
+        self.transaction_depth_request = 0
+        self.rolling_back = False
+        self.want_reconnect = False
+        self.cursor_count = 0
+        # time the outermost transaction began, for observers
+        self.transaction_started_at = None
+        # time of the last write, for read-your-writes with replicas
+        self.last_write_at = None
+        # rows loaded by cursors with identity maps, see
+        # CursorWrapper.identity_map
+        self.identity_map = None
+        # tables invalidated in the transaction, invalidated again when
+        # it commits as other threads may have cached them meanwhile
+        self.written_tables = set()
+        # once the transaction has written, (cache, arguments of put) of
+        # results read by caching cursors, stored if it commits
+        self.cache_puts = None
+        # lengths of cache_puts when each savepoint was taken
+        self.savepoint_cache_puts = []
+
+class _ThreadConnectionState(threading.local, _ConnectionState):
+    pass
+
+def _state_attribute(name):
+    def get(self):
+        return getattr(self._state, name)
+    
+    def set(self, value):
+        setattr(self._state, name, value)
+    
+    return property(get, set)
 
 class ConnectionWrapper(object):
+    '''Wraps a psycopg2 connection, tracking nested transactions.
+    
+    Passing pool_max_size enables pooled mode. In pooled mode each thread
+    checks out its own connection from a ConnectionPool when it first
+    obtains a cursor and returns it once its last cursor is closed
+    outside of a transaction. Transaction depth is tracked per thread.
+    
+    Passing replica_dsns enables read_cursor, which sends read-only work
+    to replicas chosen by replica_strategy, 'round_robin' or
+    'least_loaded'. Replicas use the same options as the primary. For
+    sticky_seconds after a session (a thread in pooled mode) writes,
+    and during transactions on the primary, read_cursor uses the primary
+    so that the session reads its own writes. A replica that fails to
+    connect or loses its connection is not used for replica_retry_interval
+    seconds.
+    '''
+    
+    conn = _state_attribute('conn')
+    want_reconnect = _state_attribute('want_reconnect')
+    _transaction_depth = _state_attribute('transaction_depth')
+    _transaction_depth_request = _state_attribute('transaction_depth_request')
+    _rolling_back = _state_attribute('rolling_back')
+    _transaction_started_at = _state_attribute('transaction_started_at')
+    
+    # dbstats.QueryObserver instances notified of statements, transactions
+    # and reconnects; replaced rather than mutated so that it can be
+    # iterated without locking
+    observers = ()
+    
     def __init__(self, dsn,
         debug_queries=False, debug_transactions=False,
         use_hstore=False,
+        pool_min_size=1, pool_max_size=None, pool_timeout=30,
+        pool_max_idle=600, pool_max_lifetime=3600, pool_check=True,
+        prepare_threshold=None, prepared_cache_size=100,
+        query_cache=None, use_savepoints=False,
+        replica_dsns=None, replica_strategy='round_robin', sticky_seconds=5,
+        replica_retry_interval=30,
     ):
         self.dsn = dsn
-        self.conn = None
         self._debug_queries = debug_queries
         self._debug_transactions = debug_transactions
-        self._transaction_depth = 0
-        self._transaction_depth_request = 0
-        self._rolling_back = False
         self._use_hstore = use_hstore
-        self.want_reconnect = False
+        # nested transactions are savepoints which can be rolled back
+        # without aborting the enclosing transaction
+        self.use_savepoints = use_savepoints
+        # statements executed prepare_threshold times on a connection
+        # are prepared on it; None disables prepared statements
+        self.prepare_threshold = prepare_threshold
+        self.prepared_cache_size = prepared_cache_size
+        self._prepared_caches = weakref.WeakKeyDictionary()
+        self._prepared_caches_lock = threading.Lock()
+        self._prepared_stats = dict.fromkeys(
+            ['hits', 'misses', 'prepared', 'evictions', 'failures', 'invalidations'], 0)
+        # used by caching cursors unless a cache is given explicitly,
+        # e.g. dbcache.shared_cache() to share results between connections
+        self.query_cache = query_cache
+        self._query_caches = weakref.WeakSet()
+        # retries made by run_in_transaction by sqlstate
+        self._retry_stats = {}
+        self._retry_stats_lock = threading.Lock()
+        if pool_max_size is None:
+            self.pool = None
+            self._state = _ConnectionState()
+        else:
+            self.pool = ConnectionPool(self._new_connection,
+                min_size=pool_min_size, max_size=pool_max_size,
+                timeout=pool_timeout, max_idle=pool_max_idle,
+                max_lifetime=pool_max_lifetime, check=pool_check,
+            )
+            self._state = _ThreadConnectionState()
+        if replica_strategy not in ('round_robin', 'least_loaded'):
+            raise ValueError('Unknown replica strategy: %s' % replica_strategy)
+        self.replica_strategy = replica_strategy
+        self.sticky_seconds = sticky_seconds
+        self.replica_retry_interval = replica_retry_interval
+        self.replicas = [ConnectionWrapper(replica_dsn,
+            debug_queries=debug_queries, debug_transactions=debug_transactions,
+            use_hstore=use_hstore,
+            pool_min_size=pool_min_size, pool_max_size=pool_max_size,
+            pool_timeout=pool_timeout, pool_max_idle=pool_max_idle,
+            pool_max_lifetime=pool_max_lifetime, pool_check=pool_check,
+            prepare_threshold=prepare_threshold,
+            prepared_cache_size=prepared_cache_size,
+        ) for replica_dsn in replica_dsns or ()]
+        self._replica_lock = threading.Lock()
+        self._replica_numbers = itertools.count()
+        # cursors open on each replica, for least_loaded
+        self._replica_load = [0] * len(self.replicas)
+        # time until which each replica is not used
+        self._replica_down_until = [0] * len(self.replicas)
+    
+    def add_observer(self, observer):
+        self.observers = tuple(self.observers) + (observer,)
+        for replica in self.replicas:
+            replica.add_observer(observer)
+    
+    def remove_observer(self, observer):
+        self.observers = tuple([existing for existing in self.observers
+            if existing is not observer])
+        for replica in self.replicas:
+            replica.remove_observer(observer)
     
     def cursor(self):
         #cursor = CursorWrapper(self.conn.cursor(), self, debug=self._debug)
         cursor = self.get_cursor()
         return TransactionalCursorContextManager(cursor)
     
-    def tx_cursor(self):
+    # n_plus_one enables detection of statements repeated with different
+    # arguments on the cursor, it is a dbstats.NPlusOneDetector or the
+    # number of repetitions above which NPlusOneError is raised
+    def tx_cursor(self, n_plus_one=None, identity_map=False):
         #cursor = CursorWrapper(self.conn.cursor(), self, debug=self._debug)
         cursor = self.get_cursor()
+        if identity_map:
+            cursor.use_identity_map = True
+            if self._state.identity_map is None:
+                self._state.identity_map = {}
+        if n_plus_one is not None:
+            if not isinstance(n_plus_one, dbstats.NPlusOneDetector):
+                n_plus_one = dbstats.NPlusOneDetector(n_plus_one)
+            cursor.add_observer(n_plus_one)
         return TransactionalCursorContextManager(cursor)
     
-    def caching_cursor(self):
-        cursor = self.get_cursor(CachingCursorWrapper)
+    # results are cached across transactions, use for data that
+    # does not change or where staleness up to ttl is acceptable
+    def caching_cursor(self, cache=None, max_entries=1000, max_bytes=None, ttl=None):
+        if cache is None:
+            cache = self.query_cache
+        if cache is None:
+            cache = dbcache.QueryCache(max_entries=max_entries,
+                max_bytes=max_bytes, ttl=ttl)
+        self._query_caches.add(cache)
+        def wrapper(cursor):
+            return CachingCursorWrapper(cursor, cache, self)
+        cursor = self.get_cursor(wrapper)
         return TransactionalCursorContextManager(cursor)
     
+    def read_cursor(self):
+        '''Returns a transactional cursor for read-only work, on a replica
+        if one is configured and usable and on the primary otherwise.'''
+        
+        index = self._choose_replica()
+        if index is None:
+            return self.tx_cursor()
+        replica = self.replicas[index]
+        try:
+            if replica.pool is None and (replica.conn is None or replica.want_reconnect):
+                replica.reconnect()
+            cursor = replica.get_cursor()
+        except (psycopg2.Error, DatabaseError):
+            self._replica_released(index, True)
+            return self.tx_cursor()
+        return _ReplicaCursorContextManager(cursor, self, index)
+    
+    def _choose_replica(self):
+        if not self.replicas:
+            return None
+        state = self._state
+        if state.transaction_depth > 0:
+            return None
+        now = time.time()
+        if state.last_write_at is not None and \
+            now - state.last_write_at < self.sticky_seconds \
+        :
+            return None
+        with self._replica_lock:
+            count = len(self.replicas)
+            start = next(self._replica_numbers) % count
+            candidates = [(start + offset) % count for offset in range(count)]
+            candidates = [index for index in candidates
+                if self._replica_down_until[index] <= now]
+            if not candidates:
+                return None
+            if self.replica_strategy == 'least_loaded':
+                index = min(candidates, key=lambda index: self._replica_load[index])
+            else:
+                index = candidates[0]
+            self._replica_load[index] += 1
+            return index
+    
+    # called when a read cursor on a replica is done with
+    def _replica_released(self, index, failed):
+        with self._replica_lock:
+            self._replica_load[index] -= 1
+        if failed:
+            self._replica_failed(index)
+    
+    def _replica_failed(self, index):
+        with self._replica_lock:
+            self._replica_down_until[index] = time.time() + self.replica_retry_interval
+        self.replicas[index].want_reconnect = True
+    
+    def replica_stats(self):
+        now = time.time()
+        with self._replica_lock:
+            return [{
+                'dsn': replica.dsn,
+                'load': self._replica_load[index],
+                'down': self._replica_down_until[index] > now,
+            } for index, replica in enumerate(self.replicas)]
+    
+    def invalidate_table(self, table):
+        '''Drops cached results of queries reading table from query_cache
+        and the caches of caching cursors obtained from this connection.'''
+        
+        caches = set(self._query_caches)
+        if self.query_cache is not None:
+            caches.add(self.query_cache)
+        for cache in caches:
+            cache.invalidate_table(table)
+        self._state.written_tables.add(table)
+    
+    # called for statements that may write, before they are executed
+    def _wrote(self):
+        state = self._state
+        if self.replicas:
+            state.last_write_at = time.time()
+        if state.cache_puts is None:
+            state.cache_puts = []
+    
     # cursor returns a context manager, we need a method that returns
     # actual cursor for fixture
     def get_cursor(self, wrapper=None):
@@ -459,7 +1891,9 @@ class ConnectionWrapper(object):
         # the transaction won't be properly setup.
         # we abort all nested transactions and next time
         # a cursor is retrieved at depth 0 we try to reconnect.
-        if self._transaction_depth == 0 and self.want_reconnect:
+        if self.pool is not None:
+            self._checkout()
+        elif self._transaction_depth == 0 and self.want_reconnect:
             self.reconnect()
         
         cursor = self.conn.cursor()
@@ -468,44 +1902,80 @@ class ConnectionWrapper(object):
         cursor = CursorWrapper(cursor, self,
             debug_queries=self._debug_queries, debug_transactions=self._debug_transactions,
         )
+        self._state.cursor_count += 1
         return cursor
     
+    def _checkout(self):
+        state = self._state
+        if state.conn is not None and state.transaction_depth == 0 and state.want_reconnect:
+            self._checkin()
+        if state.conn is None:
+            state.conn = self.pool.getconn()
+            state.want_reconnect = False
+    
+    def _checkin(self):
+        state = self._state
+        conn = state.conn
+        state.conn = None
+        self.pool.putconn(conn, close=state.want_reconnect)
+        state.want_reconnect = False
+    
+    # called by CursorWrapper.close
+    def _release_cursor(self):
+        state = self._state
+        state.cursor_count -= 1
+        if self.pool is not None and state.conn is not None and \
+            state.cursor_count <= 0 and state.transaction_depth == 0 \
+        :
+            self._checkin()
+    
     # we need to rollback transactions after failed statements
     cursor = tx_cursor
     
     def begin(self):
         if self._transaction_depth == 0:
             self._rolling_back = False
+            if self.observers:
+                self._transaction_started_at = time.time()
+        elif self.use_savepoints:
+            self._savepoint('savepoint olib_sp_%d' % (self._transaction_depth + 1))
+            cache_puts = self._state.cache_puts
+            self._state.savepoint_cache_puts.append(cache_puts and len(cache_puts) or 0)
         self._transaction_depth_request += 1
         self._transaction_depth += 1
         
         if self._debug_transactions:
-            print 'BEGIN: %d' % self._transaction_depth
+            print('BEGIN: %d' % self._transaction_depth)
     
     def commit(self):
         if self._debug_transactions:
-            print 'COMMIT: %d' % self._transaction_depth
+            print('COMMIT: %d' % self._transaction_depth)
         
         if self._rolling_back:
-            raise TransactionStateError, 'Tried to commit after a nested transaction requested a rollback (or was aborted)'
+            raise TransactionStateError('Tried to commit after a nested transaction requested a rollback (or was aborted)')
         
         transaction_depth = self._transaction_depth - 1
         transaction_depth_delta = 1
         if transaction_depth == 0:
             if self._debug_transactions:
-                print 'COMMITTING'
+                print('COMMITTING')
             
             self.conn.commit()
+            self._transaction_finished(True)
         elif transaction_depth == -1:
             if self._debug_transactions:
-                print 'COMMITTING IMPLICIT TX'
+                print('COMMITTING IMPLICIT TX')
             
             transaction_depth = 0
             transaction_depth_delta = 0
             
             self.conn.commit()
+            self._transaction_finished(True)
         elif transaction_depth < 0:
-            raise TransactionStateError, 'Requested a commit but we are not tracking a transaction in progress'
+            raise TransactionStateError('Requested a commit but we are not tracking a transaction in progress')
+        elif self.use_savepoints:
+            self._state.savepoint_cache_puts.pop()
+            self._savepoint('release savepoint olib_sp_%d' % self._transaction_depth)
         else:
             # transaction depth is 0
             pass
@@ -515,7 +1985,7 @@ class ConnectionWrapper(object):
     
     def rollback(self):
         if self._debug_transactions:
-            print 'ROLLBACK: %d' % self._transaction_depth
+            print('ROLLBACK: %d' % self._transaction_depth)
         
         transaction_depth = self._transaction_depth - 1
         transaction_depth_delta = 1
@@ -526,6 +1996,20 @@ class ConnectionWrapper(object):
             do_rollback = True
         elif transaction_depth == 0:
             do_rollback = True
+        elif self.use_savepoints:
+            depth = self._transaction_depth
+            # rows loaded since the savepoint may reflect undone writes
+            if self._state.identity_map:
+                self._state.identity_map.clear()
+            count = self._state.savepoint_cache_puts.pop()
+            if self._state.cache_puts:
+                del self._state.cache_puts[count:]
+            try:
+                self._savepoint('rollback to savepoint olib_sp_%d' % depth)
+                self._savepoint('release savepoint olib_sp_%d' % depth)
+            except psycopg2.Error:
+                # the enclosing transaction must not be committed either
+                self._rolling_back = True
         else:
             self._rolling_back = True
             # rolling back a nested transaction
@@ -533,23 +2017,217 @@ class ConnectionWrapper(object):
         
         if do_rollback:
             if self._debug_transactions:
-                print 'ROLLING BACK'
+                print('ROLLING BACK')
             
             self.conn.rollback()
+            self._transaction_finished(False)
         
         self._transaction_depth = transaction_depth
         self._transaction_depth_request -= transaction_depth_delta
     
-    def connect(self):
-        self.conn = psycopg2.connect(self.dsn)
+    def _savepoint(self, sql):
+        if self._debug_transactions:
+            print('SAVEPOINT:', sql)
+        
+        cursor = self.conn.cursor()
+        try:
+            cursor.execute(sql)
+        finally:
+            cursor.close()
+    
+    def _transaction_finished(self, committed):
+        self._state.savepoint_cache_puts = []
+        if self._state.identity_map:
+            self._state.identity_map.clear()
+        written_tables = self._state.written_tables
+        if written_tables:
+            self._state.written_tables = set()
+            if committed:
+                # this also discards results of the transaction in
+                # cache_puts reading these tables
+                for table in written_tables:
+                    self.invalidate_table(table)
+                # invalidate_table records the tables again
+                self._state.written_tables = set()
+        cache_puts = self._state.cache_puts
+        self._state.cache_puts = None
+        if committed and cache_puts:
+            for cache, put in cache_puts:
+                cache.put(*put)
+        
+        started_at = self._transaction_started_at
+        if started_at is None:
+            # implicit transaction, or observers were added during it
+            return
+        self._transaction_started_at = None
+        duration = time.time() - started_at
+        for observer in self.observers:
+            observer.on_transaction(self, duration, committed)
+    
+    # returns sql and args to execute, using a prepared statement for sql
+    # if it has been executed often enough on the current connection
+    def _prepared_statement(self, sql, args):
+        if self.prepare_threshold is None or not _preparable(sql, args):
+            return sql, args
+        conn = self.conn
+        cache = self._prepared_caches.get(conn)
+        if cache is None:
+            with self._prepared_caches_lock:
+                cache = self._prepared_caches.get(conn)
+                if cache is None:
+                    cache = self._prepared_caches[conn] = _PreparedStatementCache(
+                        self.prepared_cache_size, self.prepare_threshold,
+                        self._prepared_stats)
+        name = cache.lookup(conn, _sql_cache.lookup(sql).normalized(), sql)
+        if name is None:
+            return sql, args
+        if args:
+            sql = 'execute %s (%s)' % (name, ', '.join(['%s'] * len(args)))
+        else:
+            sql = 'execute %s' % name
+        return sql, args
+    
+    # executes sql on cursor, a psycopg2 cursor of the current connection,
+    # as a prepared statement if _prepared_statement returns one. Once a
+    # schema change alters the result type of a prepared statement it
+    # fails; the statement is then dropped and, unless the failure aborted
+    # a transaction in progress, sql is executed as is.
+    def _execute_prepared(self, cursor, sql, args):
+        exec_sql, exec_args = self._prepared_statement(sql, args)
+        if exec_sql is sql:
+            cursor.execute(sql, args)
+            return
+        conn = self.conn
+        idle = conn.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_IDLE
+        try:
+            cursor.execute(exec_sql, exec_args)
+        except psycopg2.Error as e:
+            if not _plan_changed(e):
+                raise
+            self._prepared_caches[conn].invalidate(_sql_cache.lookup(sql).normalized())
+            if not idle:
+                raise
+            # the failed statement was the only one in its transaction
+            conn.rollback()
+            cursor.execute(sql, args)
+    
+    def run_in_transaction(self, fn, retries=3, backoff=0.05, max_backoff=2):
+        '''Calls fn with a transactional cursor and returns its result.
+        
+        If the transaction fails with a serialization failure, a deadlock,
+        a lost connection or a prepared statement invalidated by a schema
+        change, it is rolled back and fn is called again in
+        a new transaction, up to retries times, after sleeping for a random
+        time of up to backoff seconds doubled on every retry, at most
+        max_backoff. fn must therefore have no side effects outside of
+        the database.
+        
+        Inside an enclosing transaction fn is not retried, as the
+        enclosing transaction is aborted as a whole.
+        '''
+        
+        if self._transaction_depth > 0:
+            with self.tx_cursor() as cursor:
+                return fn(cursor)
+        
+        attempt = 0
+        while True:
+            try:
+                with self.tx_cursor() as cursor:
+                    return fn(cursor)
+            except (psycopg2.Error, DatabaseError) as e:
+                # rolling back after a lost connection fails as well,
+                # replacing the original error
+                lost = self.want_reconnect and \
+                    isinstance(e, (psycopg2.InterfaceError, psycopg2.OperationalError))
+                self._abandon_transaction()
+                error = _retryable_error(e)
+                if error is None and lost:
+                    error = e
+                if attempt >= retries or error is None:
+                    raise
+            attempt += 1
+            sqlstate = getattr(error, 'pgcode', None) or error.__class__.__name__
+            with self._retry_stats_lock:
+                self._retry_stats[sqlstate] = self._retry_stats.get(sqlstate, 0) + 1
+            for observer in self.observers:
+                observer.on_retry(self, error, attempt)
+            time.sleep(random.uniform(0, min(max_backoff, backoff * 2 ** (attempt - 1))))
+    
+    # resets transaction state after a failed commit or rollback, which
+    # leave the transaction depth unchanged
+    def _abandon_transaction(self):
+        if self._transaction_depth == 0:
+            return
+        try:
+            self.conn.rollback()
+        except psycopg2.Error:
+            # the connection is gone, get_cursor reconnects
+            self.want_reconnect = True
+        self._transaction_depth = 0
+        self._transaction_depth_request = 0
+        self._rolling_back = False
+        self._transaction_started_at = None
+        self._state.cache_puts = None
+        self._state.savepoint_cache_puts = []
+        self._state.written_tables = set()
+        if self._state.identity_map:
+            self._state.identity_map.clear()
+        if self.pool is not None and self._state.cursor_count <= 0:
+            self._checkin()
+    
+    def retry_stats(self):
+        '''Returns the number of retries made by run_in_transaction by
+        sqlstate, or exception class name for lost connections.'''
+        
+        with self._retry_stats_lock:
+            return dict(self._retry_stats)
+    
+    def prepared_statement_stats(self):
+        stats = dict(self._prepared_stats)
+        stats['cached'] = sum([len(cache.statements)
+            for cache in self._prepared_caches.values()])
+        return stats
+    
+    def _new_connection(self):
+        conn = psycopg2.connect(self.dsn)
         if self._use_hstore:
-            psycopg2.extras.register_hstore(self.conn)
+            psycopg2.extras.register_hstore(conn)
+        return conn
+    
+    def connect(self):
+        if self.pool is not None:
+            # connections are checked out by get_cursor
+            self.pool.fill()
+        else:
+            self.conn = self._new_connection()
         self.want_reconnect = False
     
     def reconnect(self):
-        self.connect()
+        self._state.cache_puts = None
+        if self.conn is not None:
+            # prepared statements do not survive the old connection
+            self._prepared_caches.pop(self.conn, None)
+        if self.pool is not None:
+            if self.conn is not None:
+                self.pool.putconn(self.conn, close=True)
+            self.conn = self.pool.getconn()
+            self.want_reconnect = False
+        else:
+            self.connect()
+        for observer in self.observers:
+            observer.on_reconnect(self)
+    
+    def close(self):
+        if self.pool is not None:
+            self.pool.closeall()
+        elif self.conn is not None:
+            self.conn.close()
+            self.conn = None
+        for replica in self.replicas:
+            replica.close()
     
     def expr(self, value):
         return ExpressionValue(value)
 
-from .dbutils import _munge_sql, _munge_row
+from .dbutils import _munge_sql, split_sql_statements, munge_plan as _munge_plan
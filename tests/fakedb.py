@@ -0,0 +1,97 @@
+'''In-memory stand-ins for psycopg2 connections and cursors.
+
+Statements are passed to a handler, a callable taking the sql and
+arguments and returning None for statements without a result or a
+(column names, rows) pair.
+'''
+
+import psycopg2.extensions
+
+from olib import dbwrap
+
+class FakeCursor(object):
+    def __init__(self, conn):
+        self.conn = conn
+        self.description = None
+        self.rowcount = -1
+        self.rows = []
+    
+    def execute(self, sql, args=None):
+        self.conn.statements.append((sql, args))
+        result = self.conn.handler(sql, args)
+        if result is None:
+            self.description = None
+            self.rows = []
+        else:
+            names, rows = result
+            self.description = [(name, None) for name in names]
+            self.rows = list(rows)
+        self.rowcount = len(self.rows)
+    
+    def fetchone(self):
+        if self.rows:
+            return self.rows.pop(0)
+        return None
+    
+    def fetchall(self):
+        rows = self.rows
+        self.rows = []
+        return rows
+    
+    def fetchmany(self, size):
+        rows = self.rows[:size]
+        self.rows = self.rows[size:]
+        return rows
+    
+    def mogrify(self, sql, args):
+        if args is not None:
+            sql = sql % tuple([repr(arg) for arg in args])
+        return sql.encode('utf8')
+    
+    def copy_expert(self, sql, data):
+        self.conn.statements.append((sql, data.read()))
+    
+    def close(self):
+        pass
+
+class FakeConnection(object):
+    def __init__(self, handler=None):
+        self.handler = handler or (lambda sql, args: None)
+        self.statements = []
+        self.autocommit = False
+        self.encoding = 'UTF8'
+        self.closed = 0
+        self.commits = 0
+        self.rollbacks = 0
+    
+    def cursor(self, name=None):
+        return FakeCursor(self)
+    
+    def get_transaction_status(self):
+        return psycopg2.extensions.TRANSACTION_STATUS_IDLE
+    
+    def commit(self):
+        self.commits += 1
+    
+    def rollback(self):
+        self.rollbacks += 1
+    
+    def close(self):
+        self.closed = 1
+    
+    def sql(self):
+        '''Returns the executed statements without their arguments.'''
+        
+        return [statement[0] for statement in self.statements]
+
+class FakeConnectionWrapper(dbwrap.ConnectionWrapper):
+    '''A ConnectionWrapper whose connections are FakeConnections using
+    the handler given to the constructor.'''
+    
+    def __init__(self, handler=None, **kwargs):
+        self.handler = handler
+        dbwrap.ConnectionWrapper.__init__(self, 'fake', **kwargs)
+        self.connect()
+    
+    def _new_connection(self):
+        return FakeConnection(self.handler)
@@ -0,0 +1,87 @@
+import unittest
+
+from olib import dbcache
+from fakedb import FakeConnectionWrapper
+
+SELECT = 'select * from countries'
+
+class CachingCursorTest(unittest.TestCase):
+    def setUp(self):
+        self.countries = ['fr']
+        self.cache = dbcache.QueryCache()
+    
+    def handle(self, sql, args):
+        if sql.startswith('select'):
+            return ('name',), [(name,) for name in self.countries]
+    
+    def connect(self):
+        return FakeConnectionWrapper(self.handle, query_cache=self.cache)
+    
+    def select(self, conn):
+        with conn.caching_cursor() as cursor:
+            return [row.name for row in cursor.all(SELECT)]
+    
+    def test_cached(self):
+        conn = self.connect()
+        self.assertEqual(['fr'], self.select(conn))
+        self.countries.append('de')
+        self.assertEqual(['fr'], self.select(conn))
+        self.assertEqual(1, conn.conn.sql().count(SELECT))
+    
+    def test_write_invalidates(self):
+        conn = self.connect()
+        self.select(conn)
+        with conn.tx_cursor() as cursor:
+            cursor.insert_dict('countries', {'name': 'de'})
+        self.assertEqual(0, self.cache.stats()['entries'])
+    
+    def test_uncommitted_reads_not_cached(self):
+        conn = self.connect()
+        try:
+            with conn.tx_cursor() as cursor:
+                cursor.insert_dict('countries', {'name': 'de'})
+                self.countries.append('de')
+                self.assertEqual(['fr', 'de'], self.select(conn))
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(0, self.cache.stats()['entries'])
+    
+    def test_reads_cached_at_commit(self):
+        conn = self.connect()
+        with conn.tx_cursor() as cursor:
+            cursor.insert_dict('cities', {'name': 'paris'})
+            self.select(conn)
+            self.assertEqual(0, self.cache.stats()['entries'])
+        self.assertEqual(1, self.cache.stats()['entries'])
+    
+    def test_invalidated_again_at_commit(self):
+        writer = self.connect()
+        reader = self.connect()
+        with writer.tx_cursor() as cursor:
+            cursor.insert_dict('countries', {'name': 'de'})
+            # another connection caches the committed rows before the
+            # writer commits
+            self.assertEqual(['fr'], self.select(reader))
+            self.assertEqual(1, self.cache.stats()['entries'])
+        self.assertEqual(0, self.cache.stats()['entries'])
+    
+    def test_savepoint_rollback_drops_reads(self):
+        conn = FakeConnectionWrapper(self.handle, query_cache=self.cache, use_savepoints=True)
+        with conn.tx_cursor() as cursor:
+            cursor.insert_dict('cities', {'name': 'paris'})
+            with conn.caching_cursor() as caching:
+                caching.all('select * from regions')
+            try:
+                with conn.tx_cursor():
+                    self.select(conn)
+                    raise ValueError
+            except ValueError:
+                pass
+        self.assertTrue('rollback to savepoint olib_sp_2' in conn.conn.sql())
+        self.assertEqual(1, self.cache.stats()['entries'])
+        self.select(conn)
+        self.assertEqual(2, conn.conn.sql().count(SELECT))
+
+if __name__ == '__main__':
+    unittest.main()
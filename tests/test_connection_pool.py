@@ -0,0 +1,125 @@
+import threading
+import time
+import unittest
+
+import psycopg2
+import psycopg2.extensions
+
+from olib import dbwrap
+from fakedb import FakeConnection
+
+class ConnectionPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.connections = []
+        self.broken = False
+    
+    def handle(self, sql, args):
+        if self.broken:
+            raise psycopg2.OperationalError('server closed the connection')
+    
+    def connect(self):
+        conn = FakeConnection(self.handle)
+        self.connections.append(conn)
+        return conn
+    
+    def pool(self, **kwargs):
+        return dbwrap.ConnectionPool(self.connect, **kwargs)
+    
+    def test_reuse(self):
+        pool = self.pool()
+        conn = pool.getconn()
+        self.assertEqual({'size': 1, 'idle': 0, 'in_use': 1}, pool.stats())
+        pool.putconn(conn)
+        self.assertEqual({'size': 1, 'idle': 1, 'in_use': 0}, pool.stats())
+        self.assertTrue(pool.getconn() is conn)
+        self.assertEqual(1, len(self.connections))
+    
+    def test_fill(self):
+        pool = self.pool(min_size=3)
+        pool.fill()
+        self.assertEqual({'size': 3, 'idle': 3, 'in_use': 0}, pool.stats())
+    
+    def test_timeout(self):
+        pool = self.pool(max_size=1)
+        pool.getconn()
+        self.assertRaises(dbwrap.PoolTimeoutError, pool.getconn, 0.01)
+    
+    def test_waiter_gets_returned_connection(self):
+        pool = self.pool(max_size=1)
+        conn = pool.getconn()
+        result = []
+        thread = threading.Thread(target=lambda: result.append(pool.getconn(5)))
+        thread.start()
+        time.sleep(0.05)
+        pool.putconn(conn)
+        thread.join()
+        self.assertEqual([conn], result)
+    
+    def test_open_transaction_rolled_back(self):
+        pool = self.pool()
+        conn = pool.getconn()
+        conn.get_transaction_status = lambda: psycopg2.extensions.TRANSACTION_STATUS_INTRANS
+        pool.putconn(conn)
+        self.assertEqual(1, conn.rollbacks)
+        self.assertEqual(1, pool.stats()['idle'])
+    
+    def test_closed_connection_discarded(self):
+        pool = self.pool()
+        conn = pool.getconn()
+        conn.close()
+        pool.putconn(conn)
+        self.assertEqual({'size': 0, 'idle': 0, 'in_use': 0}, pool.stats())
+        pool.putconn(pool.getconn(), close=True)
+        self.assertEqual(0, pool.stats()['size'])
+        self.assertEqual(2, len(self.connections))
+    
+    def test_unusable_connection_replaced(self):
+        pool = self.pool()
+        conn = pool.getconn()
+        pool.putconn(conn)
+        self.broken = True
+        # the broken connection is discarded, its replacement is not checked
+        replacement = pool.getconn()
+        self.assertFalse(replacement is conn)
+        self.assertTrue(conn.closed)
+        self.assertEqual(1, pool.stats()['size'])
+    
+    def test_idle_connections_evicted(self):
+        pool = self.pool(min_size=1, max_idle=10)
+        first = pool.getconn()
+        second = pool.getconn()
+        pool.putconn(first)
+        pool.putconn(second)
+        # both have been idle too long, the one returned last is kept for
+        # min_size
+        pool._idle = [(conn, returned_at - 100) for conn, returned_at in pool._idle]
+        self.assertTrue(pool.getconn() is second)
+        self.assertTrue(first.closed)
+        self.assertEqual({'size': 1, 'idle': 0, 'in_use': 1}, pool.stats())
+    
+    def test_old_connections_closed(self):
+        pool = self.pool(max_lifetime=10)
+        conn = pool.getconn()
+        pool._opened_at[conn] -= 100
+        pool.putconn(conn)
+        self.assertTrue(conn.closed)
+        self.assertEqual(0, pool.stats()['size'])
+    
+    def test_failed_connect_releases_slot(self):
+        pool = dbwrap.ConnectionPool(self.fail, max_size=1)
+        self.assertRaises(psycopg2.OperationalError, pool.getconn)
+        self.assertEqual(0, pool.stats()['size'])
+    
+    def fail(self):
+        raise psycopg2.OperationalError('could not connect')
+    
+    def test_closeall(self):
+        pool = self.pool()
+        conn = pool.getconn()
+        pool.putconn(conn)
+        pool.closeall()
+        self.assertTrue(conn.closed)
+        self.assertRaises(dbwrap.PoolClosedError, pool.getconn)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+import unittest
+
+from olib import dbrow, dbutils
+
+class PivotTest(unittest.TestCase):
+    def test_rows_of_different_queries(self):
+        a = dbrow.row_class(('id', 'name'))((1, 'a'))
+        b = dbrow.row_class(('name', 'id'))(('b', 2))
+        self.assertEqual({1: a, 2: b}, dbutils.pivot([a, b], 'id'))
+        self.assertEqual({1: [a], 2: [b]}, dbutils.pivot_lists([a, b], 'id'))
+        self.assertEqual({1: {'a': a}, 2: {'b': b}}, dbutils.pivot_multi([a, b], 'id', 'name'))
+    
+    def test_iterators(self):
+        row = dbrow.row_class(('id', 'name'))
+        rows = [row((1, 'a')), row((2, 'b')), row((1, 'c'))]
+        self.assertEqual({1: rows[2], 2: rows[1]}, dbutils.pivot(iter(rows), 'id'))
+        self.assertEqual({1: [rows[0], rows[2]], 2: [rows[1]]},
+            dbutils.pivot_lists((r for r in rows), 'id'))
+        self.assertEqual({1: {'a': rows[0], 'c': rows[2]}, 2: {'b': rows[1]}},
+            dbutils.pivot_multi(iter(rows), 'id', 'name'))
+        self.assertEqual({1: 'c', 2: 'b'}, dbutils.pivot_value(iter(rows), 'id'))
+        self.assertEqual({}, dbutils.pivot_value(iter([]), 'id'))
+
+class JoinTest(unittest.TestCase):
+    def setUp(self):
+        row = dbrow.row_class(('id', 'code', 'name'))
+        self.left = [row((1, 'a', 'x')), row((2, None, 'y')), row((3, 'c', None))]
+        self.right = [row((10, 'a', 'x')), row((20, None, 'y')), row((30, None, None))]
+    
+    def test_hash_join_unique(self):
+        self.assertEqual([(self.left[0], self.right[0])],
+            dbutils.hash_join(self.left, self.right, 'code'))
+        self.assertEqual([(self.left[0], self.right[0]), (self.left[1], None), (self.left[2], None)],
+            dbutils.hash_join(self.left, self.right, 'code', how='left'))
+    
+    def test_hash_join_duplicates(self):
+        right = self.right + [self.right[0]]
+        self.assertEqual([(self.left[0], self.right[0])] * 2,
+            dbutils.hash_join(self.left, right, 'code'))
+        self.assertEqual([(self.left[0], self.right[0])] * 2 + [(self.left[1], None), (self.left[2], None)],
+            dbutils.hash_join(self.left, right, 'code', how='left'))
+    
+    def test_hash_join_composite(self):
+        self.assertEqual([(self.left[0], self.right[0])],
+            dbutils.hash_join(self.left, self.right, ('code', 'name')))
+    
+    def test_semi_join(self):
+        self.assertEqual([self.left[0]], dbutils.semi_join(self.left, self.right, 'code'))
+        self.assertEqual(self.left[1:], dbutils.semi_join(self.left, self.right, 'code', anti=True))
+        self.assertEqual([self.left[0]], dbutils.semi_join(self.left, self.right, ('code', 'name')))
+
+class GroupByTest(unittest.TestCase):
+    def test_group_by(self):
+        row = dbrow.row_class(('code', 'value', 'weight'))
+        rows = [row(('b', 1, 2)), row(('a', None, 1)), row(('b', 3, None)), row(('a', 4, 3))]
+        result = dbutils.group_by(rows, 'code', [('rows', 'count', None),
+            ('values', 'count', 'value'), ('total', 'sum', 'value'),
+            ('weights', 'list', 'weight'), ('heaviest', max, 'weight')])
+        self.assertEqual([('b', 2, 2, 4, [2], 2), ('a', 2, 1, 4, [1, 3], 3)], result)
+        self.assertEqual((4, [1, 3]), (result[1].total, result[1].weights))
+
+class IterPivotListsTest(unittest.TestCase):
+    def rows(self, count, keys):
+        return [{'id': index, 'key': 'k%d' % (index % keys), 'value': 'val%d' % index}
+            for index in range(count)]
+    
+    def test_in_memory(self):
+        rows = self.rows(50, 7)
+        groups = list(dbutils.iter_pivot_lists(rows, 'key'))
+        self.assertEqual(['k%d' % index for index in range(7)], [key for key, group in groups])
+        self.assertEqual(dbutils.pivot_lists(rows, 'key'), dict(groups))
+    
+    def test_spilled(self):
+        rows = self.rows(200, 7)
+        groups = dict(dbutils.iter_pivot_lists(rows, 'key', max_rows=20, partitions=4))
+        self.assertEqual(dbutils.pivot_lists(rows, 'key'), groups)
+    
+    def test_spilled_composite_key(self):
+        rows = self.rows(200, 7)
+        groups = dict(dbutils.iter_pivot_lists(rows, ('key', 'id'), max_rows=20, partitions=4))
+        expected = dict([((row['key'], row['id']), [row]) for row in rows])
+        self.assertEqual(expected, groups)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import unittest
+
+from fakedb import FakeConnectionWrapper
+
+SELECT = 'select * from users where id = ?'
+
+class IdentityMapTest(unittest.TestCase):
+    def setUp(self):
+        self.names = {5: 'old', 7: 'other'}
+        self.conn = FakeConnectionWrapper(self.handle)
+    
+    def handle(self, sql, args):
+        if sql.startswith('select'):
+            id = int(args[0])
+            return ('id', 'name'), [(id, self.names[id])]
+        if sql.startswith('update'):
+            # update %s set %s=%s where %s=%s
+            self.names[int(args[4])] = args[2]
+    
+    def selects(self):
+        return len([sql for sql in self.conn.conn.sql() if sql.startswith('select')])
+    
+    def test_repeated_lookup(self):
+        with self.conn.tx_cursor(identity_map=True) as cursor:
+            row = cursor.one(SELECT, 5)
+            self.assertTrue(cursor.one(SELECT, 5) is row)
+            self.assertTrue(cursor.one_by_key('users', 5) is row)
+        self.assertEqual(1, self.selects())
+    
+    def test_update_evicts_string_key(self):
+        with self.conn.tx_cursor(identity_map=True) as cursor:
+            self.assertEqual('old', cursor.one(SELECT, '5').name)
+            cursor.update('users', {'name': 'new'}, {'id': 5})
+            self.assertEqual('new', cursor.one(SELECT, '5').name)
+    
+    def test_update_keeps_other_integer_keys(self):
+        with self.conn.tx_cursor(identity_map=True) as cursor:
+            cursor.one(SELECT, 5)
+            cursor.one(SELECT, 7)
+            cursor.update('users', {'name': 'new'}, {'id': 5})
+            self.assertEqual('new', cursor.one(SELECT, 5).name)
+            self.assertEqual('other', cursor.one(SELECT, 7).name)
+        self.assertEqual(3, self.selects())
+    
+    def test_nested_cursor_write_evicts(self):
+        with self.conn.tx_cursor(identity_map=True) as cursor:
+            cursor.one(SELECT, 5)
+            with self.conn.tx_cursor() as inner:
+                inner.update('users', {'name': 'new'}, {'id': 5})
+            self.assertEqual('new', cursor.one(SELECT, 5).name)
+    
+    def test_cleared_at_commit(self):
+        with self.conn.tx_cursor(identity_map=True) as cursor:
+            cursor.one(SELECT, 5)
+        self.names[5] = 'changed'
+        with self.conn.tx_cursor(identity_map=True) as cursor:
+            self.assertEqual('changed', cursor.one(SELECT, 5).name)
+    
+    def test_disabled(self):
+        with self.conn.tx_cursor() as cursor:
+            cursor.one(SELECT, 5)
+            cursor.one(SELECT, 5)
+        self.assertEqual(2, self.selects())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,36 @@
+import unittest
+
+from olib import dbstats
+from fakedb import FakeConnectionWrapper
+
+class RecordingObserver(dbstats.QueryObserver):
+    def __init__(self):
+        self.queries = []
+    
+    def on_query(self, cursor, sql, args, duration, rowcount, error):
+        self.queries.append((sql, args, error))
+
+class IterAllTest(unittest.TestCase):
+    def setUp(self):
+        self.observer = RecordingObserver()
+        self.conn = FakeConnectionWrapper(self.handle)
+        self.conn.add_observer(self.observer)
+    
+    def handle(self, sql, args):
+        return ('id',), [(id,) for id in range(5)]
+    
+    def test_batches(self):
+        with self.conn.cursor() as cursor:
+            rows = list(cursor.iter_all2('select id from t where id < %s', (5,), batch_size=2))
+        self.assertEqual(list(range(5)), [row.id for row in rows])
+        self.assertEqual([('select id from t where id < %s', [5], None)], self.observer.queries)
+    
+    def test_write_marked(self):
+        with self.conn.tx_cursor() as cursor:
+            self.assertEqual(None, self.conn._state.cache_puts)
+            list(cursor.iter_all('update t set x = 1 returning id'))
+            self.assertEqual([], self.conn._state.cache_puts)
+        self.assertEqual(1, len(self.observer.queries))
+
+if __name__ == '__main__':
+    unittest.main()
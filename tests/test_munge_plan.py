@@ -0,0 +1,47 @@
+import unittest
+
+from olib import dbrow, dbutils
+
+def plain(value):
+    # munged rows and PropertyDicts as nested dicts
+    if isinstance(value, dbutils.PropertyDict):
+        value = value.dict()
+    elif isinstance(value, dbrow.Row):
+        value = value.asMapping()
+    else:
+        return value
+    return dict([(key, plain(item)) for key, item in value.items()])
+
+class MungePlanTest(unittest.TestCase):
+    def check(self, names, map):
+        values = tuple(range(len(names)))
+        expected = dbutils.munge_row_map(dict(zip(names, values)), map)
+        row = dbutils.munge_plan(names, map).apply(values)
+        self.assertEqual(plain(expected), plain(row))
+        return row
+    
+    def test_parts(self):
+        row = self.check(['id', 'name', 'account_id', 'account_name', 'owner_id'],
+            {'account_': 'account', 'owner_': 'owner'})
+        self.assertEqual((0, 2, 4), (row.id, row.account.id, row.owner.id))
+    
+    def test_base_prefix(self):
+        row = self.check(['user_id', 'user_name', 'account_id', 'other'],
+            {'user_': None, 'account_': 'account'})
+        self.assertEqual((0, 2, 3), (row.id, row.account.id, row.other))
+    
+    def test_part_replaces_column(self):
+        row = self.check(['id', 'account', 'account_id'], {'account_': 'account'})
+        self.assertEqual(2, row.account.id)
+    
+    def test_part_without_columns(self):
+        row = self.check(['id'], {'account_': 'account'})
+        self.assertEqual({}, row.account.asMapping())
+    
+    def test_plans_cached(self):
+        map = {'account_': 'account'}
+        self.assertTrue(dbutils.munge_plan(['id', 'account_id'], map) is
+            dbutils.munge_plan(('id', 'account_id'), map))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+import datetime
+import decimal
+import unittest
+
+from olib import dbwrap
+from fakedb import FakeConnectionWrapper
+
+SQL = 'select * from users where active = %s'
+
+class PaginateQueryTest(unittest.TestCase):
+    def test_first_page(self):
+        sql, args = dbwrap._paginate_query(SQL, ['id'], 10, None, (True,))
+        self.assertEqual('select * from (%s) as olib_page order by olib_page.%%s limit %%s' % SQL, sql)
+        self.assertEqual([True, 'id', 10], args)
+        self.assertTrue(isinstance(args[1], dbwrap.SchemaName))
+    
+    def test_same_directions(self):
+        sql, args = dbwrap._paginate_query(SQL, ['created desc', 'id DESC'], 10, [5, 7], (True,))
+        self.assertTrue(sql.endswith(' as olib_page where (olib_page.%s, olib_page.%s) < (%s, %s)'
+            ' order by olib_page.%s desc, olib_page.%s desc limit %s'))
+        self.assertEqual([True, 'created', 'id', 5, 7, 'created', 'id', 10], args)
+    
+    def test_mixed_directions(self):
+        sql, args = dbwrap._paginate_query(SQL, ['name desc', 'id'], 10, ['b', 2], ())
+        self.assertTrue(sql.endswith(' where (olib_page.%s < %s) or (olib_page.%s = %s and olib_page.%s > %s)'
+            ' order by olib_page.%s desc, olib_page.%s limit %s'))
+        self.assertEqual(['name', 'b', 'name', 'b', 'id', 2, 'name', 'id', 10], args)
+    
+    def test_errors(self):
+        self.assertRaises(ValueError, dbwrap._paginate_query, SQL, ['id'], 10, None, {'a': 1})
+        self.assertRaises(ValueError, dbwrap._paginate_query, SQL, ['id'], 10, [1, 2], ())
+        self.assertRaises(ValueError, dbwrap._paginate_query, SQL, ['id sideways'], 10, None, ())
+
+class PageTokenTest(unittest.TestCase):
+    def test_round_trip(self):
+        values = [1, u'n\xe4me', None, 1.5]
+        token = dbwrap._encode_page_token(values)
+        self.assertEqual(values, dbwrap._decode_page_token(token))
+        self.assertFalse('+' in token or '/' in token)
+    
+    def test_values_without_json_representation(self):
+        token = dbwrap._encode_page_token([datetime.datetime(2020, 1, 2, 3, 4, 5),
+            datetime.date(2020, 1, 2), decimal.Decimal('1.50')])
+        self.assertEqual(['2020-01-02 03:04:05', '2020-01-02', '1.50'],
+            dbwrap._decode_page_token(token))
+    
+    def test_invalid(self):
+        for token in ['not a token', dbwrap._encode_page_token({'a': 1}), u'\xe4']:
+            self.assertRaises(ValueError, dbwrap._decode_page_token, token)
+
+class IterPagesTest(unittest.TestCase):
+    def setUp(self):
+        self.ids = list(range(1, 8))
+    
+    def handle(self, sql, args):
+        # [column, after, column, limit] or [column, limit]
+        ids = self.ids
+        if ' where ' in sql:
+            ids = [id for id in ids if id > args[1]]
+        return ('id',), [(id,) for id in ids[:args[-1]]]
+    
+    def test_iter_pages(self):
+        conn = FakeConnectionWrapper(self.handle)
+        with conn.cursor() as cursor:
+            pages = [[row.id for row in rows] for rows in cursor.iter_pages('select id from t', ['id'], 3)]
+        self.assertEqual([[1, 2, 3], [4, 5, 6], [7]], pages)
+    
+    def test_last_page_full(self):
+        self.ids = self.ids[:6]
+        conn = FakeConnectionWrapper(self.handle)
+        with conn.cursor() as cursor:
+            rows, token = cursor.paginate('select id from t', ['id'], 3)
+            rows, token = cursor.paginate('select id from t', ['id'], 3, token)
+            self.assertEqual([4, 5, 6], [row.id for row in rows])
+            # a full page may be the last, the next one is empty
+            self.assertEqual(([], None), cursor.paginate('select id from t', ['id'], 3, token))
+        self.assertEqual(3, len(conn.conn.statements))
+
+if __name__ == '__main__':
+    unittest.main()
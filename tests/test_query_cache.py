@@ -0,0 +1,102 @@
+import unittest
+
+from olib import dbcache
+
+class QueryCacheTest(unittest.TestCase):
+    def put(self, cache, key, tables=('countries',), rows=None, generation=None):
+        if rows is None:
+            rows = [(key,)]
+        cache.put(key, rows, [('name', None)], frozenset(tables), generation)
+    
+    def test_hit_and_miss(self):
+        cache = dbcache.QueryCache()
+        self.assertEqual(None, cache.get('a'))
+        self.put(cache, 'a')
+        self.assertEqual([('a',)], cache.get('a').rows)
+        stats = cache.stats()
+        self.assertEqual((1, 1, 0.5), (stats['hits'], stats['misses'], stats['hit_ratio']))
+    
+    def test_least_recently_used_evicted(self):
+        cache = dbcache.QueryCache(max_entries=2)
+        self.put(cache, 'a')
+        self.put(cache, 'b')
+        cache.get('a')
+        self.put(cache, 'c')
+        self.assertEqual(None, cache.get('b'))
+        self.assertTrue(cache.get('a') is not None)
+        self.assertTrue(cache.get('c') is not None)
+        self.assertEqual(1, cache.stats()['evictions'])
+    
+    def test_max_bytes(self):
+        rows = [('x' * 100,)] * 10
+        size = dbcache._approximate_size(rows)
+        cache = dbcache.QueryCache(max_bytes=size * 2)
+        self.put(cache, 'a', rows=rows)
+        self.put(cache, 'b', rows=rows)
+        self.assertEqual(2 * size, cache.stats()['bytes'])
+        self.put(cache, 'c', rows=rows)
+        self.assertEqual(None, cache.get('a'))
+        self.assertEqual(2 * size, cache.stats()['bytes'])
+        # results larger than the whole cache are not stored
+        self.put(cache, 'd', rows=rows * 3)
+        self.assertEqual(None, cache.get('d'))
+        self.assertEqual(2, cache.stats()['entries'])
+    
+    def test_ttl(self):
+        cache = dbcache.QueryCache(ttl=0)
+        self.put(cache, 'a')
+        self.assertEqual(None, cache.get('a'))
+        self.assertEqual({'entries': 0, 'bytes': 0, 'expirations': 1},
+            dict([(name, cache.stats()[name]) for name in ('entries', 'bytes', 'expirations')]))
+        cache = dbcache.QueryCache(ttl=60)
+        self.put(cache, 'a')
+        self.assertTrue(cache.get('a') is not None)
+    
+    def test_invalidate_table(self):
+        cache = dbcache.QueryCache()
+        self.put(cache, 'a', tables=('countries', 'cities'))
+        self.put(cache, 'b', tables=('cities',))
+        self.put(cache, 'c', tables=('users',))
+        cache.invalidate_table('public.Cities')
+        self.assertEqual(None, cache.get('a'))
+        self.assertEqual(None, cache.get('b'))
+        self.assertTrue(cache.get('c') is not None)
+        self.assertEqual(2, cache.stats()['invalidations'])
+    
+    def test_generations(self):
+        cache = dbcache.QueryCache()
+        generation = cache.generation()
+        cache.invalidate_table('users')
+        # only invalidations of the result's tables discard it
+        self.put(cache, 'a', generation=generation)
+        self.assertTrue(cache.get('a') is not None)
+        cache.invalidate_table('countries')
+        self.put(cache, 'b', generation=generation)
+        self.assertEqual(None, cache.get('b'))
+        self.put(cache, 'c', generation=cache.generation())
+        self.assertTrue(cache.get('c') is not None)
+    
+    def test_clear_discards_queries_in_flight(self):
+        cache = dbcache.QueryCache()
+        self.put(cache, 'a')
+        generation = cache.generation()
+        cache.clear()
+        self.assertEqual(0, cache.stats()['entries'])
+        self.put(cache, 'b', generation=generation)
+        self.assertEqual(None, cache.get('b'))
+
+class CacheKeyTest(unittest.TestCase):
+    def test_tables_in_sql(self):
+        self.assertEqual(frozenset(['countries', 'Cities', 'users']), dbcache.tables_in_sql(
+            'select * from Countries c join public."Cities" ci on true '
+            'where exists (select 1 from users)'))
+    
+    def test_cache_key(self):
+        self.assertNotEqual(dbcache.cache_key('select %s', (1,)), dbcache.cache_key('select %s', (True,)))
+        self.assertEqual(dbcache.cache_key('select %(a)s, %(b)s', {'a': 1, 'b': 2}),
+            dbcache.cache_key('select %(a)s, %(b)s', {'b': 2, 'a': 1}))
+        # unhashable arguments fall back to their repr
+        self.assertEqual(dbcache.cache_key('select %s', ([1, 2],)), dbcache.cache_key('select %s', ([1, 2],)))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+import unittest
+
+from olib.dbutils import split_sql_statements
+
+class SplitSqlStatementsTest(unittest.TestCase):
+    def test_plain(self):
+        self.assertEqual(['select 1', 'select 2'], split_sql_statements(' select 1 ;\n select 2 '))
+        self.assertEqual(['select 1'], split_sql_statements('select 1;;'))
+    
+    def test_strings(self):
+        self.assertEqual(["select 'a;b''c;'", 'select 2'],
+            split_sql_statements("select 'a;b''c;'; select 2"))
+        self.assertEqual(['select "a;""b" from t', 'select 2'],
+            split_sql_statements('select "a;""b" from t; select 2'))
+    
+    def test_escape_strings(self):
+        self.assertEqual(["select E'it\\'s; here'", 'select 2'],
+            split_sql_statements("select E'it\\'s; here'; select 2"))
+        self.assertEqual(["select e'a'';b\\\\'", 'select 2'],
+            split_sql_statements("select e'a'';b\\\\'; select 2"))
+    
+    def test_dollar_quotes(self):
+        self.assertEqual(['select $$a;b$$', 'select 2'],
+            split_sql_statements('select $$a;b$$; select 2'))
+        function = 'create function f() returns int as $body$ select 1; $x$;$x$ $body$ language sql'
+        self.assertEqual([function, 'select 2'], split_sql_statements(function + '; select 2'))
+        self.assertEqual(['select 1', 'select $tag$ unterminated;'],
+            split_sql_statements('select 1; select $tag$ unterminated;'))
+    
+    def test_dollar_in_identifiers(self):
+        self.assertEqual(['select a$b$c from t', 'select $1', 'select c$ from u'],
+            split_sql_statements('select a$b$c from t; select $1; select c$ from u'))
+    
+    def test_nested_block_comments(self):
+        self.assertEqual(['select 1 /* outer /* inner; */ still; */', 'select 2'],
+            split_sql_statements('select 1 /* outer /* inner; */ still; */; select 2'))
+    
+    def test_comment_only_statements(self):
+        self.assertEqual(['select 1 -- a; b'],
+            split_sql_statements('select 1 -- a; b\n; -- c;\n; /* d; */ ;'))
+
+if __name__ == '__main__':
+    unittest.main()